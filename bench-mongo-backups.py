@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+__VERSION__ = '0.1'
+
+from moto import mock_aws
+from pymongo import MongoClient
+import argparse
+import boto3
+import collections
+import importlib.util
+import json
+import logging
+import math
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Summary metrics where a larger value is an improvement. Every other metric
+# is a latency or size where a larger value is a regression.
+HIGHER_IS_BETTER = ('copy_throughput_mb_s',)
+
+
+def parse_args():
+    """ Do all command line parsing and return the results as an argparse
+        Namespace. """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--mongo-name', dest='mongo_name', required=False, default='bench',
+        help='The name of the benchmark mongo cluster.'
+    )
+    parser.add_argument(
+        '--aws-region', dest='aws_region', required=False,
+        default='us-east-1',
+        help='The region of the mocked AWS account.'
+    )
+    parser.add_argument(
+        '--vg-name', dest='vg_name', required=False, default='vgbench',
+        help=('The LVM volume group name created for the benchmark.')
+    )
+    parser.add_argument(
+        '--lv-name', dest='lv_name', required=False, default='lvmongo',
+        help=('The LVM logical volume name created for the benchmark.')
+    )
+    parser.add_argument(
+        '--vg-size', dest='vg_size', type=int, required=False, default=2048,
+        help=('The size in MB of the loop device backing the volume group.')
+    )
+    parser.add_argument(
+        '--data-size', dest='data_size', type=int, required=False,
+        default=256,
+        help=('The size in MB of synthetic data to seed mongod with.')
+    )
+    parser.add_argument(
+        '--file-count', dest='file_count', type=int, required=False,
+        default=16,
+        help=('The number of collections, and so data files, to seed.')
+    )
+    parser.add_argument(
+        '--runs', dest='runs', type=int, required=False, default=3,
+        help=('The number of backups to run.')
+    )
+    parser.add_argument(
+        '--mongod', dest='mongod', required=False, default='mongod',
+        help=('The mongod binary to run.')
+    )
+    parser.add_argument(
+        '--mongo-port', dest='mongo_port', type=int, required=False,
+        default=27117,
+        help=('The port the benchmark mongod listens on.')
+    )
+    parser.add_argument(
+        '--stripes', dest='stripes', type=int, required=False, default=1,
+        help=('The number of staging volumes to stripe the copy across.')
+    )
+    parser.add_argument(
+        '--no-mongo-lock', dest='mongo_lock', action='store_false',
+        default=True,
+        help=('Do not lock mongo before performing the LVM snapshot.')
+    )
+    parser.add_argument(
+        '--baseline', dest='baseline', default=None,
+        help=('A JSON file of baseline results to compare against.')
+    )
+    parser.add_argument(
+        '--write-baseline', dest='write_baseline', action='store_true',
+        default=False,
+        help=('Write this run\'s summary to --baseline instead of comparing.')
+    )
+    parser.add_argument(
+        '--regression-threshold', dest='regression_threshold', type=float,
+        required=False, default=0.10,
+        help=('Flag a regression when a metric is worse than the baseline '
+              'by this fraction.')
+    )
+    return parser.parse_args()
+
+
+def run(command):
+    """ Run command, raising on failure, and return its stripped output. """
+
+    return subprocess.check_output(command).decode().strip()
+
+
+def load_mongo_backups():
+    """ Import mongo-backups.py, whose file name is not a valid module
+        name. """
+
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'mongo-backups.py'
+    )
+    spec = importlib.util.spec_from_file_location('mongo_backups', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LoopDevices:
+    """ Sparse files attached as loop devices, keyed by name. """
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.devices = collections.OrderedDict()
+
+    def create(self, name, size):
+        """ Create a loop device of size MB and return its path. """
+
+        path = os.path.join(self.work_dir, '{0}.img'.format(name))
+        with open(path, 'wb') as fh:
+            fh.truncate(size * 1024 * 1024)
+        device = run(['losetup', '--find', '--show', path])
+        self.devices[name] = (device, path)
+        return device
+
+    def remove(self, name):
+        """ Detach the loop device name and delete its backing file. """
+
+        device, path = self.devices.pop(name)
+        run(['losetup', '--detach', device])
+        os.remove(path)
+
+    def close(self):
+        for name in reversed(list(self.devices)):
+            self.remove(name)
+
+
+class LocalMongod:
+    """ A forked mongod serving a benchmark data directory. """
+
+    def __init__(self, mongod, db_path, port):
+        self.mongod = mongod
+        self.db_path = db_path
+        self.port = port
+
+    @property
+    def uri(self):
+        return 'mongodb://127.0.0.1:{0}/'.format(self.port)
+
+    def start(self):
+        # --fork reparents mongod away from this process, so its memory is
+        # not counted in the children's peak RSS.
+        run([
+            self.mongod, '--fork', '--dbpath', self.db_path,
+            '--port', str(self.port), '--bind_ip', '127.0.0.1',
+            '--logpath', os.path.join(self.db_path, 'mongod.log'),
+        ])
+        MongoClient(self.uri).admin.command('ping')
+
+    def seed(self, data_size, file_count):
+        """ Insert data_size MB of incompressible documents spread across
+            file_count collections. """
+
+        db = MongoClient(self.uri).bench
+        db.client.drop_database('bench')
+        document_size = 64 * 1024
+        documents = max(
+            1, data_size * 1024 * 1024 // document_size // file_count
+        )
+        for index in range(file_count):
+            collection = db['collection{0}'.format(index)]
+            for start in range(0, documents, 64):
+                collection.insert_many([
+                    {'payload': os.urandom(document_size)}
+                    for _ in range(min(64, documents - start))
+                ])
+        db.client.admin.command('fsync')
+
+    def stop(self):
+        try:
+            MongoClient(
+                self.uri, serverSelectionTimeoutMS=2000
+            ).admin.command('shutdown')
+        except Exception:
+            # shutdown closes the connection before replying, and mongod
+            # may never have started.
+            pass
+        # Give mongod time to release the data directory.
+        time.sleep(1)
+
+
+class Environment:
+    """ A loop device backed volume group and mongod, plus a mocked AWS
+        account holding an instance with the live volume attached. """
+
+    def __init__(self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.loop_devices = LoopDevices(work_dir)
+        self.device_dir = os.path.join(work_dir, 'dev')
+        self.data_dir = os.path.join(work_dir, 'data')
+        self.mongod = LocalMongod(
+            args.mongod, self.data_dir, args.mongo_port
+        )
+        self.mongo_uri_file = os.path.join(work_dir, 'mongo-uri')
+
+    def setup(self):
+        args = self.args
+        pv = self.loop_devices.create('pv', args.vg_size)
+        run(['pvcreate', '-q', pv])
+        run(['vgcreate', '-q', args.vg_name, pv])
+        run(['lvcreate', '-q', '-y', '--extents', '80%FREE',
+             '--name', args.lv_name, args.vg_name])
+        lv = '/dev/{0}/{1}'.format(args.vg_name, args.lv_name)
+        run(['mkfs.xfs', '-q', lv])
+        os.makedirs(self.data_dir)
+        run(['mount', lv, self.data_dir])
+
+        # Attached volumes appear as xvd* links in device_dir. xvda stands
+        # in for the root volume so the next free device is xvdb.
+        os.makedirs(self.device_dir)
+        os.symlink(pv, os.path.join(self.device_dir, 'xvda'))
+
+        self.mongod.start()
+        logger.info(
+            "Seeding mongod [size={0}MB, files={1}].".
+            format(args.data_size, args.file_count)
+        )
+        self.mongod.seed(args.data_size, args.file_count)
+        with open(self.mongo_uri_file, 'w') as fh:
+            fh.write(self.mongod.uri)
+
+        ec2 = boto3.client('ec2', args.aws_region)
+        image_id = ec2.describe_images(Owners=['amazon'])['Images'][0]
+        reservation = ec2.run_instances(
+            ImageId=image_id['ImageId'], MinCount=1, MaxCount=1
+        )
+        instance = reservation['Instances'][0]
+        self.instance_id = instance['InstanceId']
+        self.live_volume_id = ec2.create_volume(
+            AvailabilityZone=instance['Placement']['AvailabilityZone'],
+            Size=int(math.ceil(args.vg_size / 1024.0)), VolumeType='gp3',
+            TagSpecifications=[{
+                'ResourceType': 'volume',
+                'Tags': [
+                    {'Key': 'MongoName', 'Value': args.mongo_name},
+                    {'Key': 'MongoLiveVolume', 'Value': 'True'},
+                ],
+            }]
+        )['VolumeId']
+        ec2.attach_volume(
+            Device=pv, InstanceId=self.instance_id,
+            VolumeId=self.live_volume_id
+        )
+
+    def teardown(self):
+        self.mongod.stop()
+        subprocess.call(['umount', self.data_dir])
+        subprocess.call(['vgremove', '-q', '-f', self.args.vg_name])
+        self.loop_devices.close()
+
+
+def bench_class(module):
+    """ Return a MongoBackups subclass for the benchmark environment. """
+
+    class BenchMongoBackups(module.MongoBackups):
+        """ MongoBackups against the mocked AWS account, where attaching a
+            volume creates a loop device of the same size. """
+
+        def __init__(self, *args, **kwargs):
+            self.environment = kwargs.pop('environment')
+            super().__init__(*args, **kwargs)
+
+        @property
+        def instance_id(self):
+            return self.environment.instance_id
+
+        def ebs_attach_volume(self, volume_id, device):
+            response = super().ebs_attach_volume(volume_id, device)
+            volume = self.client.describe_volumes(VolumeIds=[volume_id])
+            loop = self.environment.loop_devices.create(
+                volume_id, volume['Volumes'][0]['Size'] * 1024
+            )
+            os.symlink(loop, os.path.join(self.device_dir, device))
+            return response
+
+        def ebs_detach_volume(self, volume_id, device):
+            os.remove(os.path.join(self.device_dir, device))
+            self.environment.loop_devices.remove(volume_id)
+            return super().ebs_detach_volume(volume_id, device)
+
+    return BenchMongoBackups
+
+
+def run_backup(module, environment):
+    """ Run one backup and return its metrics. """
+
+    args = environment.args
+    mongo_backups = bench_class(module)(
+        args.mongo_name, args.aws_region, args.vg_name, args.lv_name,
+        mongo_lock=args.mongo_lock, stripes=args.stripes,
+        mongo_uri_file=environment.mongo_uri_file,
+        device_dir=environment.device_dir, environment=environment
+    )
+    volume = mongo_backups.client.describe_volumes(
+        VolumeIds=[environment.live_volume_id]
+    )['Volumes'][0]
+
+    mongo_backups.stats['date_started'] = module.dt.now().isoformat()
+    mongo_backups.stats['time_started'] = time.time()
+    start = time.perf_counter()
+    mongo_backups.backup(volume)
+    total = time.perf_counter() - start
+
+    metrics = collections.OrderedDict()
+    metrics['total_seconds'] = total
+    for name, seconds in mongo_backups.stats['phases'].items():
+        metrics['phase_{0}_seconds'.format(name)] = seconds
+    # Nothing is locked with --no-mongo-lock.
+    if mongo_backups.stats['lock_hold_seconds'] is not None:
+        metrics['lock_hold_seconds'] = mongo_backups.stats['lock_hold_seconds']
+
+    rsync_stats = {
+        tag['Key']: float(tag['Value'])
+        for tag in mongo_backups.stats['rsync_stats']
+    }
+    transferred = rsync_stats.get('rsync_total_transferred_file_size', 0)
+    metrics['copy_throughput_mb_s'] = (
+        transferred / (1024 * 1024) / mongo_backups.stats['phases']['copy']
+    )
+
+    # ru_maxrss is in KB on Linux and is a high-water mark for the process
+    # lifetime, so it only ever grows across runs.
+    metrics['peak_rss_mb'] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    )
+    metrics['peak_child_rss_mb'] = (
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    )
+    return metrics
+
+
+def summarise(runs):
+    """ Return the median of each metric across runs. """
+
+    summary = collections.OrderedDict()
+    for name in runs[0]:
+        summary[name] = statistics.median(run[name] for run in runs)
+    return summary
+
+
+def compare(summary, baseline, threshold):
+    """ Return a list of metrics in summary which are worse than baseline
+        by more than threshold. """
+
+    regressions = []
+    for name, value in summary.items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        change = (value - expected) / expected
+        if name in HIGHER_IS_BETTER:
+            change = -change
+        if change > threshold:
+            regressions.append(collections.OrderedDict([
+                ('metric', name),
+                ('baseline', expected),
+                ('value', value),
+                ('change', change),
+            ]))
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit('The benchmark must run as root to manage loop devices.')
+
+    # moto only needs credentials to be present.
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+    module = load_mongo_backups()
+    work_dir = tempfile.mkdtemp(prefix='mongo-backups-bench-')
+    environment = Environment(args, work_dir)
+
+    runs = []
+    with mock_aws():
+        try:
+            environment.setup()
+            for index in range(args.runs):
+                logger.info("Benchmark run [{0}/{1}].".
+                            format(index + 1, args.runs))
+                runs.append(run_backup(module, environment))
+        finally:
+            environment.teardown()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = summarise(runs)
+    report = collections.OrderedDict([
+        ('data_size_mb', args.data_size),
+        ('file_count', args.file_count),
+        ('mongo_lock', args.mongo_lock),
+        ('stripes', args.stripes),
+        ('runs', runs),
+        ('summary', summary),
+        ('regressions', []),
+    ])
+
+    if args.baseline and args.write_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump(summary, fh, indent=4)
+    elif args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        report['regressions'] = compare(
+            summary, baseline, args.regression_threshold
+        )
+
+    print(json.dumps(report, indent=4))
+    return 1 if report['regressions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
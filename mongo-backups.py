@@ -3,10 +3,15 @@
 __VERSION__ = '0.1'
 
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime as dt
 import argparse
 import boto3
+import collections
+import concurrent.futures
+import contextlib
 import fnmatch
+import gzip
 import os
 import re
 import requests
@@ -15,6 +20,7 @@ import sys
 import time
 import string
 import tempfile
+import threading
 import lvm
 import math
 import tzlocal
@@ -23,6 +29,17 @@ import json
 
 TZ = tzlocal.get_localzone()
 
+# Each cluster's run history is stored as its own gzipped, columnar JSON
+# object named <mongo_name><HISTORY_SUFFIX> within the history location.
+# Agents of a sharded cluster backup set run concurrently under one
+# mongo_name, so each writes <mongo_name>.<instance_id><HISTORY_SUFFIX>.
+HISTORY_SUFFIX = '.history.json.gz'
+HISTORY_FORMAT_VERSION = 1
+
+# The volume group and logical volume striped across staging volumes.
+STAGING_VG_NAME = 'vgmongobackups'
+STAGING_LV_NAME = 'lvmongobackups'
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 logging.getLogger('botocore').setLevel(logging.WARN)
 logging.getLogger('boto3').setLevel(logging.WARN)
@@ -50,8 +67,10 @@ def parse_args():
     )
     parser.add_argument(
         '--action', dest='action', nargs='?',
-        choices=('dev', 'backup'),
-        default='backup', help=('Choose backup here.')
+        choices=('dev', 'backup', 'orchestrate'),
+        default='backup',
+        help=('Choose backup here, or orchestrate to coordinate the backup '
+              'set of a sharded cluster.')
     )
     parser.add_argument(
         '--vg-name', dest='vg_name',
@@ -68,6 +87,12 @@ def parse_args():
         default=False,
         help=('Lock Mongo before performing snapshot.')
     )
+    parser.add_argument(
+        '--max-lock-hold', dest='max_lock_hold', type=float,
+        required=False, default=10,
+        help=('The time in seconds after which Mongo is force-unlocked and '
+              'the backup abandoned.')
+    )
     parser.add_argument(
         '--mongo-uri-file', dest='mongo_uri_file', default=None,
         help=('File containing mongo URI connection string.')
@@ -81,9 +106,480 @@ def parse_args():
         '--cloudwatch-log-group-name', dest='log_group_name',
         default=None, help=('CloudWatch log group name.')
     )
+    parser.add_argument(
+        '--history-location', dest='history_location', default=None,
+        help=('Local directory or s3://bucket/prefix to append this run\'s '
+              'stats to.')
+    )
+    parser.add_argument(
+        '--backup-set-id', dest='backup_set_id', default=None,
+        help=('The id of the sharded cluster backup set this backup belongs '
+              'to. The orchestrator and every agent must share it.')
+    )
+    parser.add_argument(
+        '--barrier-uri-file', dest='barrier_uri_file', default=None,
+        help=('File containing the mongos URI connection string used to '
+              'coordinate a backup set.')
+    )
+    parser.add_argument(
+        '--barrier-timeout', dest='barrier_timeout', type=int,
+        required=False, default=600,
+        help=('The time in seconds to wait for every agent in a backup set.')
+    )
+    parser.add_argument(
+        '--barrier-finish-timeout', dest='barrier_finish_timeout', type=int,
+        required=False, default=7200,
+        help=('The time in seconds the orchestrator waits for every agent in '
+              'a backup set to copy and snapshot its data.')
+    )
+    parser.add_argument(
+        '--barrier-lead', dest='barrier_lead', type=float,
+        required=False, default=0.5,
+        help=('The time in seconds between the orchestrator releasing the '
+              'barrier and every agent locking.')
+    )
+    parser.add_argument(
+        '--backup-set-parties', dest='backup_set_parties', type=int,
+        required=False, default=None,
+        help=('The number of agents in a backup set. Defaults to one per '
+              'shard plus the config server.')
+    )
+    parser.add_argument(
+        '--stripes', dest='stripes', type=int, required=False, default=1,
+        help=('The number of staging volumes to create and stripe with LVM. '
+              'Use 0 to choose from the data size and --target-duration.')
+    )
+    parser.add_argument(
+        '--max-stripes', dest='max_stripes', type=int, required=False,
+        default=8,
+        help=('The largest number of staging volumes chosen automatically.')
+    )
+    parser.add_argument(
+        '--stripe-size', dest='stripe_size', type=int, required=False,
+        default=256,
+        help=('The LVM stripe size, and XFS stripe unit, in KB.')
+    )
+    parser.add_argument(
+        '--target-duration', dest='target_duration', type=int,
+        required=False, default=1800,
+        help=('The time in seconds the copy should take when choosing the '
+              'number of stripes.')
+    )
+    parser.add_argument(
+        '--volume-throughput', dest='volume_throughput', type=int,
+        required=False, default=125,
+        help=('The throughput in MB/s of one staging volume when choosing '
+              'the number of stripes.')
+    )
     return parser.parse_args()
 
 
+def read_uri_file(uri_file):
+    """ Return the mongo URI connection string within uri_file. """
+
+    with open(uri_file) as fh:
+        return fh.read().rstrip()
+
+
+def split_s3_uri(uri):
+    """ Return a (bucket, prefix) tuple if uri is an s3:// uri, otherwise
+        None. """
+
+    if not uri.startswith('s3://'):
+        return None
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix = prefix + '/'
+    return bucket, prefix
+
+
+class LockWindow:
+    """ Hold mongod's fsync lock only for the duration of one command.
+
+    prepare() connects to mongod and validates it before anything is locked.
+    run() then locks, runs the command without a shell and unlocks in a
+    finally block. A watchdog thread force-unlocks mongod if the lock is
+    held for longer than max_hold seconds. The command itself is always
+    left to finish; killing lvcreate part way through can leave the origin
+    volume suspended. Without a mongo_uri the command is run without
+    locking or any time limit.
+
+    hold_seconds is the time from requesting the lock until mongod was
+    unlocked, by run() or the watchdog, or None if it was never locked.
+
+    """
+
+    def __init__(self, mongo_uri=None, max_hold=10):
+        self.mongo_uri = mongo_uri
+        self.max_hold = max_hold
+        self.admin = None
+        self.locked = False
+        self.forced = False
+        self.lock_ns = None
+        self.hold_ns = None
+        self.mutex = threading.Lock()
+
+    @property
+    def hold_seconds(self):
+        if self.hold_ns is None:
+            return None
+        return self.hold_ns / 1e9
+
+    @property
+    def hold_text(self):
+        """ hold_seconds formatted for logging. """
+
+        if self.hold_ns is None:
+            return 'not locked'
+        return '{0:.3f}ms'.format(self.hold_ns / 1e6)
+
+    def prepare(self):
+        """ Connect to mongod and confirm it is not already locked. """
+
+        if not self.mongo_uri:
+            return
+        client = MongoClient(self.mongo_uri)
+        # ping forces the connection handshake now rather than when
+        # locking.
+        client.admin.command('ping')
+        if client.admin.command('currentOp').get('fsyncLock'):
+            raise Exception('Mongo is already fsync locked.')
+        self.admin = client.admin
+
+    def unlock(self, forced=False):
+        with self.mutex:
+            if self.locked:
+                self.admin.command('fsyncUnlock')
+                self.hold_ns = time.perf_counter_ns() - self.lock_ns
+                self.locked = False
+                self.forced = forced
+
+    def force_unlock(self):
+        self.unlock(forced=True)
+
+    def run(self, command):
+        """ Run command within the lock window. Raise if the command fails
+            or mongod was force-unlocked. """
+
+        watchdog = None
+        try:
+            if self.admin:
+                self.lock_ns = time.perf_counter_ns()
+                self.admin.command('fsync', lock=True)
+                self.locked = True
+                if self.max_hold:
+                    watchdog = threading.Timer(
+                        self.max_hold, self.force_unlock
+                    )
+                    watchdog.daemon = True
+                    watchdog.start()
+            result = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        finally:
+            self.unlock()
+            if watchdog:
+                watchdog.cancel()
+
+        if self.forced:
+            raise Exception(
+                'Mongo was force-unlocked after being held for longer than '
+                '{0}s.'.format(self.max_hold)
+            )
+        if result.returncode:
+            raise Exception(
+                '{0} failed [returncode={1}]: {2}'.
+                format(command[0], result.returncode,
+                       result.stderr.decode().strip())
+            )
+        return result
+
+
+class BackupSetBarrier:
+    """ An agent's view of a backup set barrier.
+
+    Every agent in a sharded cluster backup set records its arrival in the
+    mongo_backups.backup_sets collection, reached through mongos. Once all
+    agents have arrived the orchestrator sets a release time slightly in the
+    future, and every agent locks and snapshots at that wall clock time. An
+    agent which reaches the release time more than the orchestrator's lead
+    late fails the whole set rather than locking out of step, and an agent
+    which arrives after the set has been released is refused.
+
+    Agents should back up a secondary (or hidden) member of each shard so
+    the barrier's own writes are never blocked by an fsync lock.
+
+    """
+
+    def __init__(self, uri, backup_set_id, agent_id, timeout=600,
+                 poll_interval=0.01):
+        self.collection = MongoClient(uri).mongo_backups.backup_sets
+        self.backup_set_id = backup_set_id
+        self.agent_id = agent_id
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # The number of agents in the set, known once it is released.
+        self.parties = None
+
+    def wait(self):
+        """ Arrive at the barrier and block until its release time. """
+
+        # The upsert only inserts, and so collides with the existing
+        # document, when the set has already been released.
+        try:
+            self.collection.update_one(
+                {'_id': self.backup_set_id,
+                 'release_at': {'$exists': False}},
+                {'$addToSet': {'arrived': self.agent_id}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            raise Exception(
+                'Backup set {0} has already been released.'.
+                format(self.backup_set_id)
+            )
+
+        deadline = time.time() + self.timeout
+        while True:
+            backup_set = self.collection.find_one(
+                {'_id': self.backup_set_id}
+            )
+            self.raise_if_failed(backup_set)
+            if 'release_at' in backup_set:
+                break
+            if time.time() > deadline:
+                raise Exception(
+                    'Timed out waiting for backup set {0} to be released.'.
+                    format(self.backup_set_id)
+                )
+            time.sleep(self.poll_interval)
+
+        self.parties = backup_set['parties']
+        delay = backup_set['release_at'] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        elif -delay > backup_set['lead']:
+            reason = (
+                '{0} reached the barrier {1:.3f}s after its release.'.
+                format(self.agent_id, -delay)
+            )
+            self.fail(reason)
+            raise Exception(
+                'Backup set {0} failed: {1}'.format(self.backup_set_id, reason)
+            )
+
+    def raise_if_failed(self, backup_set):
+        if backup_set.get('state') in ('aborted', 'failed'):
+            raise Exception(
+                'Backup set {0} was {1} [reason={2}].'.
+                format(self.backup_set_id, backup_set['state'],
+                       backup_set.get('reason'))
+            )
+
+    def check(self):
+        """ Raise if the backup set has failed since this agent was
+            released, so its snapshot is never kept. """
+
+        self.raise_if_failed(
+            self.collection.find_one({'_id': self.backup_set_id})
+        )
+
+    def fail(self, reason):
+        """ Mark the backup set failed so every agent abandons it. """
+
+        self.collection.update_one(
+            {'_id': self.backup_set_id},
+            {'$set': {'state': 'failed', 'reason': reason}}
+        )
+
+    def snapshotted(self, lock_started, lock_finished):
+        """ Record that this agent's LVM snapshot has been taken. """
+
+        self.collection.update_one(
+            {'_id': self.backup_set_id},
+            {'$push': {'snapshotted': {
+                'agent': self.agent_id,
+                'lock_started': lock_started,
+                'lock_finished': lock_finished,
+            }}}
+        )
+
+    def finished(self, snapshot_ids):
+        """ Record this agent's EBS snapshots as members of the set. """
+
+        self.collection.update_one(
+            {'_id': self.backup_set_id},
+            {'$push': {'finished': {
+                'agent': self.agent_id, 'snapshot_ids': snapshot_ids,
+            }}}
+        )
+
+
+class BackupSetOrchestrator:
+    """ Coordinate a consistent backup of a sharded cluster.
+
+    The orchestrator stops the balancer, waits for every agent to arrive at
+    the BackupSetBarrier, releases them together and waits until each has
+    taken its LVM snapshot. The balancer is then restored while the agents
+    copy their snapshots in parallel, and the set only completes once every
+    agent has taken its EBS snapshots. The set fails if the agents' locks
+    started more than lead seconds apart, or if any agent fails or has not
+    finished within finish_timeout seconds.
+
+    A backup set id may only be run once.
+
+    """
+
+    def __init__(self, uri, backup_set_id, parties=None, timeout=600,
+                 lead=0.5, log=logger.info, poll_interval=0.05,
+                 finish_timeout=7200):
+        self.client = MongoClient(uri)
+        self.collection = self.client.mongo_backups.backup_sets
+        self.backup_set_id = backup_set_id
+        self.parties = parties
+        self.timeout = timeout
+        self.lead = lead
+        self.log = log
+        self.poll_interval = poll_interval
+        self.finish_timeout = finish_timeout
+
+    def wait_for(self, field, parties, timeout=None):
+        """ Block until the backup set's field lists parties entries and
+            return the backup set. """
+
+        deadline = time.time() + (timeout or self.timeout)
+        while True:
+            backup_set = self.collection.find_one(
+                {'_id': self.backup_set_id}
+            )
+            if backup_set.get('state') == 'failed':
+                raise Exception(
+                    'Backup set {0} failed: {1}'.
+                    format(self.backup_set_id, backup_set.get('reason'))
+                )
+            if len(backup_set.get(field, [])) >= parties:
+                return backup_set
+            if time.time() > deadline:
+                raise Exception(
+                    'Timed out waiting for {0} of {1} agents to be {2} '
+                    '[backup_set_id={3}].'.
+                    format(parties - len(backup_set.get(field, [])),
+                           parties, field, self.backup_set_id)
+                )
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        """ Run the backup set and return a dict describing its lock
+            window. """
+
+        admin = self.client.admin
+        parties = self.parties
+        if not parties:
+            parties = len(admin.command('listShards')['shards']) + 1
+
+        # Agents may already have arrived, but a set which has a state has
+        # been run before and its arrivals and snapshots are stale.
+        try:
+            self.collection.update_one(
+                {'_id': self.backup_set_id, 'state': {'$exists': False}},
+                {'$set': {'parties': parties, 'state': 'waiting',
+                          'created': time.time()}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            raise Exception(
+                'Backup set {0} has already been run. Use a new backup set '
+                'id.'.format(self.backup_set_id)
+            )
+
+        balancer_mode = admin.command('balancerStatus')['mode']
+        self.log("Stopping the balancer [mode={0}].".format(balancer_mode))
+        admin.command('balancerStop', maxTimeMS=self.timeout * 1000)
+
+        state = 'aborted'
+        reason = None
+        try:
+            self.log(
+                "Waiting for agents [backup_set_id={0}, parties={1}].".
+                format(self.backup_set_id, parties)
+            )
+            self.wait_for('arrived', parties)
+
+            state = 'failed'
+            self.collection.update_one(
+                {'_id': self.backup_set_id},
+                {'$set': {'state': 'released', 'lead': self.lead,
+                          'release_at': time.time() + self.lead}}
+            )
+            self.log("Released agents [backup_set_id={0}].".
+                     format(self.backup_set_id))
+            backup_set = self.wait_for('snapshotted', parties)
+
+            snapshotted = backup_set['snapshotted']
+            lock_started = [agent['lock_started'] for agent in snapshotted]
+            lock_finished = [agent['lock_finished'] for agent in snapshotted]
+            window = {
+                'backup_set_id': self.backup_set_id,
+                'parties': parties,
+                'lock_start_spread': max(lock_started) - min(lock_started),
+                'lock_window': max(lock_finished) - min(lock_started),
+            }
+            self.log(
+                "Backup set snapshotted [backup_set_id={0}, "
+                "lock_start_spread={1:.3f}s, lock_window={2:.3f}s].".
+                format(self.backup_set_id, window['lock_start_spread'],
+                       window['lock_window'])
+            )
+            if window['lock_start_spread'] > self.lead:
+                reason = (
+                    'Locks started {0:.3f}s apart, more than the {1}s '
+                    'lead.'.format(window['lock_start_spread'], self.lead)
+                )
+                raise Exception(
+                    'Backup set {0} failed: {1}'.
+                    format(self.backup_set_id, reason)
+                )
+            state = 'snapshotted'
+        finally:
+            update = {'state': state}
+            if reason:
+                update['reason'] = reason
+            self.collection.update_one(
+                {'_id': self.backup_set_id}, {'$set': update}
+            )
+            if balancer_mode != 'off':
+                self.log("Starting the balancer.")
+                admin.command('balancerStart')
+
+        self.log(
+            "Waiting for agents to finish [backup_set_id={0}].".
+            format(self.backup_set_id)
+        )
+        try:
+            backup_set = self.wait_for(
+                'finished', parties, self.finish_timeout
+            )
+        except Exception as e:
+            # Keep the reason of an agent which failed the set itself.
+            self.collection.update_one(
+                {'_id': self.backup_set_id, 'state': 'snapshotted'},
+                {'$set': {'state': 'failed', 'reason': str(e)}}
+            )
+            raise
+        self.collection.update_one(
+            {'_id': self.backup_set_id}, {'$set': {'state': 'completed'}}
+        )
+        window['snapshot_ids'] = [
+            snapshot_id for agent in backup_set['finished']
+            for snapshot_id in agent['snapshot_ids']
+        ]
+        self.log(
+            "Backup set completed [backup_set_id={0}, snapshot_ids={1}].".
+            format(self.backup_set_id, ', '.join(window['snapshot_ids']))
+        )
+        return window
+
+
 class MongoBackups:
     def __init__(self, mongo_name, aws_region, vg_name, lv_name, **kwargs):
         self.mongo_name = mongo_name
@@ -103,6 +599,29 @@ class MongoBackups:
         self.mongo_lock = kwargs.get('mongo_lock')
         self.mongo_uri_file = kwargs.get('mongo_uri_file')
 
+        # Run-history attributes.
+        self.history_location = kwargs.get('history_location')
+
+        # The directory walked to discover attached block devices.
+        self.device_dir = kwargs.get('device_dir', '/dev/')
+
+        # Sharded cluster backup set attributes. barrier is a
+        # BackupSetBarrier when this backup is one agent of a backup set.
+        self.backup_set_id = kwargs.get('backup_set_id')
+        self.barrier = kwargs.get('barrier')
+
+        # The longest time in seconds mongo may stay locked before the
+        # LockWindow watchdog force-unlocks it.
+        self.max_lock_hold = kwargs.get('max_lock_hold', 10)
+
+        # Staging volume striping attributes. A stripes of 0 chooses the
+        # number of stripes from the data size and target duration.
+        self.stripes = kwargs.get('stripes', 1)
+        self.max_stripes = kwargs.get('max_stripes', 8)
+        self.stripe_size = kwargs.get('stripe_size', 256)
+        self.target_duration = kwargs.get('target_duration', 1800)
+        self.volume_throughput = kwargs.get('volume_throughput', 125)
+
     def log(self, message, console=True):
         """ Log message.
 
@@ -144,9 +663,7 @@ class MongoBackups:
                 'is set.'
             )
         if self.mongo_uri_file:
-            with open(self.mongo_uri_file) as fh:
-                mongo_uri = fh.read()
-            mongo_uri = mongo_uri.rstrip()
+            mongo_uri = read_uri_file(self.mongo_uri_file)
 
         return mongo_uri
 
@@ -211,6 +728,12 @@ class MongoBackups:
 
         return self.session.client('logs', self.aws_region)
 
+    @property
+    def s3(self):
+        """ A client connection to S3. """
+
+        return self.session.client('s3', self.aws_region)
+
     @property
     def instance(self):
         """ A instance connection to EC2. """
@@ -244,7 +767,7 @@ class MongoBackups:
 
         latest_block_device = None
 
-        for root, dirs, files in os.walk('/dev/'):
+        for root, dirs, files in os.walk(self.device_dir):
             block_devices = [f for f in files if re.match(includes, f)]
             if block_devices:
                 block_devices.sort()
@@ -255,6 +778,12 @@ class MongoBackups:
     def get_next_free_block_device(self):
         """Return the next free block device by walking /dev.  """
 
+        return self.get_next_free_block_devices(1)[0]
+
+    def get_next_free_block_devices(self, count):
+        """Return a list of the next count free block devices by walking
+           /dev.  """
+
         latest_block_device = self.get_latest_block_device()
 
         # Create a list of all potential block devices.
@@ -265,10 +794,16 @@ class MongoBackups:
         # Grab the index for the latest known block device.
         _index = all_block_devices.index(latest_block_device)
 
-        # Grab the next free block device from the list.
-        next_free_block_device = all_block_devices[_index + 1]
+        # Grab the next free block devices from the list.
+        start = _index + 1
+        next_free_block_devices = all_block_devices[start:start + count]
+        if len(next_free_block_devices) < count:
+            raise Exception(
+                'There are not {0} free block devices after {1}.'.
+                format(count, latest_block_device)
+            )
 
-        return next_free_block_device
+        return next_free_block_devices
 
     def ebs_create_volume(self, size, volume_type, encrypted=True,
                           availability_zone=None, snapshot_id=None):
@@ -297,44 +832,71 @@ class MongoBackups:
 
         return self.client.create_volume(**kwargs)
 
-    def ebs_create_snapshot(self, volume_id):
-        """ Perform an EBS snapshot on volume_id. """
+    @property
+    def snapshot_name(self):
+        """ The Name and Description of this instance's snapshots, something
+            like "MongoBackups-customerA-i-00ab0281eff3b2a63". """
 
-        # Set Name and Description tags to something like
-        # "MongoBackups-customerA-i-00ab0281eff3b2a63".
-        name = "MongoBackups-{0}-{1}".format(
+        return "MongoBackups-{0}-{1}".format(
             self.mongo_name, self.instance_id
         )
-        description = name
 
-        self.stats['date_finished'] = dt.now().isoformat()
+    def snapshot_tags(self, date_finished, extra_tags=None):
+        """ Return the tags of a snapshot finished at date_finished, adding
+            extra_tags to the standard tags. """
 
-        self.snapshot_tags = [
+        name = self.snapshot_name
+        snapshot_tags = [
             {'Key': 'InstanceId', 'Value': self.instance_id},
             {'Key': 'Name', 'Value': name},
-            {'Key': 'Description', 'Value': description},
+            {'Key': 'Description', 'Value': name},
             {'Key': 'MongoName', 'Value': self.mongo_name},
             {'Key': 'MongoBackups', 'Value': 'True'},
             {'Key': 'DateStarted', 'Value': self.stats['date_started']},
-            {'Key': 'DateFinished', 'Value': self.stats['date_finished']},
+            {'Key': 'DateFinished', 'Value': date_finished},
             {'Key': 'MongoBackupsVersion', 'Value': __VERSION__}
         ]
+        # A backup set is only complete once it holds a snapshot, or stripe
+        # set, from each of its parties.
+        if self.barrier:
+            snapshot_tags.extend([
+                {'Key': 'BackupSetId', 'Value': self.backup_set_id},
+                {'Key': 'BackupSetParties',
+                 'Value': str(self.barrier.parties)},
+            ])
+
+        # append rsync stats and extra tags to tags.
+        return snapshot_tags + self.stats['rsync_stats'] + (extra_tags or [])
 
-        # append rsync stats to tags.
-        self.snapshot_tags = self.snapshot_tags + self.stats['rsync_stats']
+    def ebs_create_snapshot(self, volume_id, tags):
+        """ Perform an EBS snapshot on volume_id with tags. """
 
         resp = self.client.create_snapshot(
-            Description=description, VolumeId=volume_id,
+            Description=self.snapshot_name, VolumeId=volume_id,
             TagSpecifications=[
                 {
                     'ResourceType': 'snapshot',
-                    'Tags': self.snapshot_tags
+                    'Tags': tags
                 }
             ]
         )
 
         return resp
 
+    def ebs_delete_snapshot(self, snapshot_id):
+        """ Delete an EBS snapshot. """
+
+        return self.client.delete_snapshot(SnapshotId=snapshot_id)
+
+    def ebs_attach_volume(self, volume_id, device):
+        """ Attach an EBS volume to this instance. """
+
+        return self.client.attach_volume(
+            Device=device,
+            InstanceId=self.instance_id,
+            VolumeId=volume_id
+        )
+
     def ebs_detach_volume(self, volume_id, device):
         """ Detach an EBS volume. """
 
@@ -376,6 +938,40 @@ class MongoBackups:
 
         return data
 
+    @property
+    def data_size(self):
+        """ Return the bytes used on the logical volume, or its size if it
+            is not mounted. """
+
+        origin = os.path.realpath(
+            '/dev/mapper/{0}-{1}'.format(self.vg_name, self.lv_name)
+        )
+        with open('/proc/mounts') as fh:
+            for line in fh:
+                device, mount_point = line.split()[:2]
+                if os.path.realpath(device) == origin:
+                    st = os.statvfs(mount_point)
+                    return (st.f_blocks - st.f_bfree) * st.f_frsize
+        return self.logical_volume['lvsize'] * 1024 * 1024 * 1024
+
+    @property
+    def stripe_count(self):
+        """ Return the number of staging volumes to stripe across.
+
+        Unless stripes is set, enough stripes are chosen for data_size to
+        be copied at volume_throughput MB/s per volume within
+        target_duration seconds, up to max_stripes.
+
+        """
+
+        if self.stripes:
+            return self.stripes
+        data_mb = self.data_size / (1024.0 * 1024)
+        stripes = int(math.ceil(
+            data_mb / (self.volume_throughput * self.target_duration)
+        ))
+        return max(1, min(self.max_stripes, stripes))
+
     @property
     def last_snapshot(self):
         """ Return a dict which represents the last snapshot. """
@@ -400,6 +996,18 @@ class MongoBackups:
 
         return last_snapshot
 
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Record the seconds spent within the block in
+            stats['phases'][name]. """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases = self.stats.setdefault('phases', collections.OrderedDict())
+            phases[name] = time.perf_counter() - start
+
     def capture_rsync_stats(self, rsync_output):
         """ Take output from rsnapshot and store statistics in stats
             member. """
@@ -424,193 +1032,411 @@ class MongoBackups:
                 )
         return self.stats
 
+    @property
+    def history_record(self):
+        """ Return a dict of this run's stats, suitable for appending to
+            the run-history store. Rsync stats are stored as floats. """
+
+        record = {
+            'mongo_name': self.mongo_name,
+            'aws_region': self.aws_region,
+            'instance_id': self.instance_id,
+            'snapshot_id': self.stats.get('snapshot_id'),
+            'backup_set_id': self.backup_set_id,
+            'version': __VERSION__,
+            'lock_hold_seconds': self.stats.get('lock_hold_seconds'),
+            'stripes': len(self.stats.get('snapshot_ids', [])) or None,
+            'time_started': self.stats['time_started'],
+            'time_finished': self.stats['time_finished'],
+            'duration_seconds': (
+                self.stats['time_finished'] - self.stats['time_started']
+            ),
+        }
+        for name, seconds in self.stats.get('phases', {}).items():
+            record['phase_{0}_seconds'.format(name)] = seconds
+        for tag in self.stats.get('rsync_stats', []):
+            try:
+                record[tag['Key']] = float(tag['Value'])
+            except ValueError:
+                record[tag['Key']] = None
+        return record
+
+    def history_read(self, key):
+        """ Return the raw bytes of the history object key within
+            history_location, or None if it does not exist yet. """
+
+        s3_uri = split_s3_uri(self.history_location)
+        if s3_uri:
+            bucket, prefix = s3_uri
+            # Every access to self.s3 builds a new client, whose exception
+            # classes would not match those raised by this one.
+            s3 = self.s3
+            try:
+                response = s3.get_object(Bucket=bucket, Key=prefix + key)
+            except s3.exceptions.NoSuchKey:
+                return None
+            return response['Body'].read()
+
+        path = os.path.join(self.history_location, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def history_write(self, key, body):
+        """ Write body to the history object key within
+            history_location. """
+
+        s3_uri = split_s3_uri(self.history_location)
+        if s3_uri:
+            bucket, prefix = s3_uri
+            self.s3.put_object(Bucket=bucket, Key=prefix + key, Body=body)
+            return
+
+        # Write to a temporary file first so a failed run never leaves a
+        # truncated history behind.
+        os.makedirs(self.history_location, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.history_location)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(body)
+        os.replace(temp_path, os.path.join(self.history_location, key))
+
+    def history_append(self):
+        """ Append this run's history_record to the cluster's columnar
+            run-history store.
+
+        The store is a gzipped JSON document holding one list per column,
+        padded with nulls so every column has one entry per run.
 
-def main():
-    args = parse_args()
+        """
 
-    mongo_backups = MongoBackups(
-        args.mongo_name, args.aws_region, args.vg_name, args.lv_name,
-        log_group_name=args.log_group_name, mongo_lock=args.mongo_lock,
-        mongo_uri_file=args.mongo_uri_file
-    )
+        key = self.mongo_name + HISTORY_SUFFIX
+        if self.backup_set_id:
+            key = '{0}.{1}{2}'.format(
+                self.mongo_name, self.instance_id, HISTORY_SUFFIX
+            )
+        body = self.history_read(key)
+        if body:
+            history = json.loads(gzip.decompress(body).decode())
+        else:
+            history = {'format_version': HISTORY_FORMAT_VERSION, 'runs': 0,
+                       'columns': {}}
+
+        runs = history['runs']
+        columns = history['columns']
+        record = self.history_record
+        for name in set(columns) | set(record):
+            columns.setdefault(name, [None] * runs).append(record.get(name))
+        history['runs'] = runs + 1
+
+        self.history_write(
+            key,
+            gzip.compress(json.dumps(history, separators=(',', ':')).encode())
+        )
+        return history
 
-    mongo_backups.stats['date_started'] = dt.now().isoformat()
+    def record_history(self):
+        """ Append this run's stats to the run-history store, returning
+            True on success.
 
-    _filter = mongo_backups.volume_filter
-    volumes = mongo_backups.client.describe_volumes(Filters=_filter)
+        The backup has already succeeded by the time history is recorded,
+        so a history store which cannot be read or written is logged
+        rather than raised.
 
-    if args.action == 'backup':
-        for volume in volumes['Volumes']:
+        """
 
-            attached_instance_id = volume['Attachments'][0]['InstanceId']
-            attached_device = volume['Attachments'][0]['Device']
+        self.log(
+            "Appending run stats to history [{0}].".
+            format(self.history_location)
+        )
+        try:
+            self.history_append()
+        except Exception as e:
+            self.log(
+                "Failed to append run stats to history [{0}]: {1}".
+                format(self.history_location, e)
+            )
+            return False
+        return True
 
-            # Confirm that the live volume we are checking belongs to this
-            # instance and shares the same block device attachment. If we dont
-            # do this, we could backup a mongo instance we dont want backing
-            # up.
-            if (attached_instance_id == mongo_backups.instance_id and
-                    attached_device in mongo_backups.physical_block_devices):
-
-                # Create new volume.
-                size = mongo_backups.logical_volume['lvsize']
-                volume_type = volume['VolumeType']
-
-                if args.seed_from_last_snapshot:
-                    mongo_backups.log(
-                        "Creating a new volume from the last "
-                        "snapshot [snapshot_id={0}, volume_type={1}]."
-                        .format(
-                            mongo_backups.last_snapshot['snapshot_id'],
-                            volume_type
-                        )
-                    )
-                    if not mongo_backups.last_snapshot['snapshot_id']:
-                        mongo_backups.log("No snapshots exist yet.")
-                        sys.exit(2)
-                    else:
-                        new_volume = mongo_backups.ebs_create_volume(
-                            size=None, volume_type=volume_type,
-                            snapshot_id=(
-                                mongo_backups.last_snapshot['snapshot_id']
-                            )
-                        )
-                else:
-                    mongo_backups.log(
-                        "Creating a new volume [size={0}GB, volume_type={1}]."
-                        .format(size, volume_type)
+    def backup(self, volume, wait_time=60, seed_from_last_snapshot=False):
+        """ Backup the live volume to a new EBS snapshot and return the
+            snapshot.
+
+        The time taken by each phase is recorded in stats['phases'].
+
+        """
+
+        self.stats['phases'] = collections.OrderedDict()
+
+        with self.phase('create_volume'):
+            # Create new volumes, one per stripe.
+            size = self.logical_volume['lvsize']
+            volume_type = volume['VolumeType']
+            stripes = self.stripe_count
+
+            if seed_from_last_snapshot:
+                if stripes > 1:
+                    raise Exception(
+                        'Seeding from the last snapshot is not supported '
+                        'with striped staging volumes.'
                     )
-                    new_volume = mongo_backups.ebs_create_volume(
-                        size, volume_type
+                self.log(
+                    "Creating a new volume from the last "
+                    "snapshot [snapshot_id={0}, volume_type={1}]."
+                    .format(
+                        self.last_snapshot['snapshot_id'],
+                        volume_type
                     )
-
-                # Wait for new volume to be available.
-                mongo_backups.log(
-                    "Waiting for new volume to become available [{0}]."
-                    .format(new_volume['VolumeId'])
                 )
-                waiter = mongo_backups.client.get_waiter('volume_available')
-                waiter.wait(VolumeIds=[new_volume['VolumeId']])
-                mongo_backups.log(
-                    "Volume available [{0}].".format(new_volume['VolumeId'])
+                if not self.last_snapshot['snapshot_id']:
+                    self.log("No snapshots exist yet.")
+                    sys.exit(2)
+                else:
+                    new_volumes = [self.ebs_create_volume(
+                        size=None, volume_type=volume_type,
+                        snapshot_id=(
+                            self.last_snapshot['snapshot_id']
+                        )
+                    )]
+            else:
+                # Each stripe holds an equal share of the data, plus room
+                # for LVM metadata.
+                if stripes > 1:
+                    size = int(math.ceil(size / stripes)) + 1
+                availability_zone = self.instance.placement[
+                    'AvailabilityZone'
+                ]
+                self.log(
+                    "Creating new volumes [count={0}, size={1}GB, "
+                    "volume_type={2}].".format(stripes, size, volume_type)
                 )
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=stripes) as executor:
+                    new_volumes = list(executor.map(
+                        lambda _: self.ebs_create_volume(
+                            size, volume_type,
+                            availability_zone=availability_zone
+                        ),
+                        range(stripes)
+                    ))
+
+            volume_ids = [v['VolumeId'] for v in new_volumes]
+
+            # Wait for new volumes to be available.
+            self.log(
+                "Waiting for new volumes to become available [{0}]."
+                .format(', '.join(volume_ids))
+            )
+            waiter = self.client.get_waiter('volume_available')
+            waiter.wait(VolumeIds=volume_ids)
+            self.log(
+                "Volumes available [{0}].".format(', '.join(volume_ids))
+            )
 
-                last_block_device = mongo_backups.get_latest_block_device()
-                mongo_backups.log(
-                    "Last block device attached [{0}].".
-                    format(last_block_device)
-                )
+        with self.phase('attach_volume'):
+            last_block_device = self.get_latest_block_device()
+            self.log(
+                "Last block device attached [{0}].".
+                format(last_block_device)
+            )
 
-                # Found next free block device.
-                attach_device = mongo_backups.get_next_free_block_device()
-                mongo_backups.log(
-                    "Next available block device found [{0}].".
-                    format(attach_device)
-                )
+            # Found next free block devices.
+            attach_devices = self.get_next_free_block_devices(
+                len(volume_ids)
+            )
+            self.log(
+                "Next available block devices found [{0}].".
+                format(', '.join(attach_devices))
+            )
 
-                # Attach volume to instance.
-                mongo_backups.log(
+            # Attach volumes to instance.
+            for volume_id, attach_device in zip(volume_ids, attach_devices):
+                self.log(
                     "Attaching volume [volume_id={0}, device={1}].".
-                    format(new_volume['VolumeId'], attach_device)
-                )
-                mongo_backups.client.attach_volume(
-                    Device=attach_device,
-                    InstanceId=mongo_backups.instance_id,
-                    VolumeId=new_volume['VolumeId']
+                    format(volume_id, attach_device)
                 )
-
-                # wait whilst the volume attaches itself and is registered
-                # with the kernel
-                count = 0
-                while count < args.wait_time:
-                    latest_block_device = \
-                        mongo_backups.get_latest_block_device()
-                    time.sleep(1)
-                    mongo_backups.log(
-                        "Waiting for new block device to attach [{0}]."
-                        .format(attach_device)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(volume_ids)) as executor:
+                list(executor.map(
+                    self.ebs_attach_volume, volume_ids, attach_devices
+                ))
+
+            # wait whilst the volumes attach themselves and are registered
+            # with the kernel
+            new_devices = [
+                os.path.join(self.device_dir, attach_device)
+                for attach_device in attach_devices
+            ]
+            missing = new_devices
+            count = 0
+            while count < wait_time:
+                count = count + 1
+                time.sleep(1)
+                missing = [d for d in new_devices if not os.path.exists(d)]
+                if not missing:
+                    self.log(
+                        "New block devices attached [{0}].".
+                        format(', '.join(new_devices))
                     )
-                    if last_block_device != latest_block_device:
-                        mongo_backups.log(
-                            "New block device attached [{0}].".
-                            format(latest_block_device)
-                        )
-                        break
-
-                # Create a filesystem on the new block device.
-                mongo_backups.log(
-                    "Creating xfs filesystem [/dev/{0}].".
-                    format(latest_block_device)
+                    break
+                self.log(
+                    "Waiting for new block devices to attach [{0}]."
+                    .format(', '.join(missing))
                 )
-                subprocess.call(
-                    'mkfs.xfs /dev/{0}'.
-                    format(latest_block_device),
-                    shell=True
+            if missing:
+                self.abandon_new_volumes(volume_ids, attach_devices)
+                raise Exception(
+                    'Block devices did not attach within {0}s [{1}].'.
+                    format(wait_time, ', '.join(missing))
                 )
 
-                # Make a temporary mount points for the new volume and LVM
-                # snapshot.
-                mongo_backups.log("Creating temporary mount point directories.")
-                temp_mount_point_new_volume = tempfile.mkdtemp(
-                    prefix='/media/'
+        with self.phase('mkfs'):
+            # Stripe multiple new block devices into one logical volume
+            # and match the filesystem geometry to the stripes.
+            mkfs_options = ''
+            if len(new_devices) > 1:
+                try:
+                    new_device = self.create_striped_volume(new_devices)
+                except Exception:
+                    self.abandon_new_volumes(volume_ids, attach_devices)
+                    raise
+                mkfs_options = (
+                    '-d su={0}k,sw={1},agcount={2} '.
+                    format(self.stripe_size, len(new_devices),
+                           len(new_devices) * 4)
                 )
-                temp_mount_point_lvsnap = tempfile.mkdtemp(prefix='/media/')
+            else:
+                new_device = new_devices[0]
 
-                # Mount the new block device at temporary mount point.
-                mongo_backups.log(
-                    "Mounting new block device [dev=/dev/{0}, dest={1}].".
-                    format(latest_block_device, temp_mount_point_new_volume)
-                )
-                subprocess.call(
-                    'mount /dev/{0} {1}'.
-                    format(latest_block_device, temp_mount_point_new_volume),
-                    shell=True
-                )
+            # Create a filesystem on the new block device.
+            self.log(
+                "Creating xfs filesystem [{0}{1}].".
+                format(mkfs_options, new_device)
+            )
+            subprocess.call(
+                'mkfs.xfs {0}{1}'.
+                format(mkfs_options, new_device),
+                shell=True
+            )
 
-                # Lock mongo.
-                if mongo_backups.mongo_lock:
-                    mongo_backups.log("Locking mongo.")
-                    conn = MongoClient(mongo_backups.mongo_uri)
-                    conn.fsync(lock=True)
+            # Make a temporary mount points for the new volume and LVM
+            # snapshot.
+            self.log("Creating temporary mount point directories.")
+            temp_mount_point_new_volume = tempfile.mkdtemp(
+                prefix='/media/'
+            )
+            temp_mount_point_lvsnap = tempfile.mkdtemp(prefix='/media/')
 
-                # Create LVM snapshot.
-                mongo_backups.log(
-                    "Creating LVM snapshot [vg={0}, lv={1}].".
-                    format(mongo_backups.vg_name, mongo_backups.lv_name)
-                )
-                subprocess.call(
-                    'lvcreate -L300M -s -n lvsnap '
-                    '/dev/mapper/{0}-{1}'
-                    .format(mongo_backups.vg_name, mongo_backups.lv_name),
-                    shell=True
-                )
+            # Mount the new block device at temporary mount point.
+            self.log(
+                "Mounting new block device [dev={0}, dest={1}].".
+                format(new_device, temp_mount_point_new_volume)
+            )
+            subprocess.call(
+                'mount {0} {1}'.
+                format(new_device, temp_mount_point_new_volume),
+                shell=True
+            )
 
-                # Unlock mongo.
-                if mongo_backups.mongo_lock:
-                    mongo_backups.log("Unlocking mongo.")
-                    conn.unlock()
+        # Connect to mongo and validate everything the snapshot needs
+        # before locking, so the lock is only held for the snapshot itself.
+        with self.phase('lock_prepare'):
+            lock_window = LockWindow(
+                self.mongo_uri if self.mongo_lock else None,
+                max_hold=self.max_lock_hold
+            )
+            try:
+                self.validate_lvm_snapshot()
+                lock_window.prepare()
+            except Exception:
+                self.abandon_new_volumes(
+                    volume_ids, attach_devices, temp_mount_point_new_volume
+                )
+                raise
 
-                # Mount LVM snapshot in read-only.
-                lvm_snapshot_mount_args = 'nouuid,ro'
-                mongo_backups.log(
-                    "Mounting LVM snapshot [mount_args={0}, "
-                    "dev=/dev/{1}/lvsnap, dest={2}].".
-                    format(
-                        lvm_snapshot_mount_args, mongo_backups.vg_name,
-                        temp_mount_point_lvsnap
+        # Wait for every agent in the backup set so all shards lock and
+        # snapshot together.
+        if self.barrier:
+            with self.phase('barrier'):
+                self.log(
+                    "Waiting at backup set barrier [{0}].".
+                    format(self.backup_set_id)
+                )
+                try:
+                    self.barrier.wait()
+                except Exception:
+                    self.abandon_new_volumes(
+                        volume_ids, attach_devices,
+                        temp_mount_point_new_volume
                     )
+                    raise
+
+        # Create LVM snapshot, with mongo locked if requested. Nothing is
+        # logged until mongo has been unlocked.
+        self.log(
+            "Creating LVM snapshot [vg={0}, lv={1}, mongo_lock={2}, "
+            "max_lock_hold={3}s].".
+            format(self.vg_name, self.lv_name, self.mongo_lock,
+                   self.max_lock_hold)
+        )
+        with self.phase('lock_window'):
+            lock_started = time.time()
+            try:
+                lock_window.run(self.lvm_snapshot_command)
+            except Exception:
+                self.stats['lock_hold_seconds'] = lock_window.hold_seconds
+                self.log(
+                    "LVM snapshot failed [lock_hold={0}, "
+                    "forced_unlock={1}].".
+                    format(lock_window.hold_text, lock_window.forced)
                 )
                 subprocess.call(
-                    'mount -o nouuid,ro /dev/{0}/lvsnap {1}'.
-                    format(mongo_backups.vg_name, temp_mount_point_lvsnap),
+                    'lvremove -y /dev/{0}/lvsnap'.format(self.vg_name),
                     shell=True
                 )
+                if self.barrier:
+                    self.barrier.fail(
+                        '{0} failed to create its LVM snapshot.'.
+                        format(self.barrier.agent_id)
+                    )
+                self.abandon_new_volumes(
+                    volume_ids, attach_devices, temp_mount_point_new_volume
+                )
+                raise
+            lock_finished = time.time()
+
+        self.stats['lock_hold_seconds'] = lock_window.hold_seconds
+        self.log(
+            "LVM snapshot created [lock_hold={0}].".
+            format(lock_window.hold_text)
+        )
+        if self.barrier:
+            self.barrier.snapshotted(lock_started, lock_finished)
 
-                # Rsync LVM snapshot to new volume.
-                mongo_backups.log(
-                    "Performing rsync [src={0}, dest={1}].".
-                    format(temp_mount_point_lvsnap, temp_mount_point_new_volume)
+        with self.phase('copy'):
+            # Mount LVM snapshot in read-only.
+            lvm_snapshot_mount_args = 'nouuid,ro'
+            self.log(
+                "Mounting LVM snapshot [mount_args={0}, "
+                "dev=/dev/{1}/lvsnap, dest={2}].".
+                format(
+                    lvm_snapshot_mount_args, self.vg_name,
+                    temp_mount_point_lvsnap
                 )
+            )
+            subprocess.call(
+                'mount -o nouuid,ro /dev/{0}/lvsnap {1}'.
+                format(self.vg_name, temp_mount_point_lvsnap),
+                shell=True
+            )
+
+            # Rsync LVM snapshot to new volume.
+            self.log(
+                "Performing rsync [src={0}, dest={1}].".
+                format(temp_mount_point_lvsnap, temp_mount_point_new_volume)
+            )
+            try:
                 rsync_output = subprocess.check_output(
                     'rsync -a --stats --delete --ignore-missing-args '
                     '-p {0}/* {1}/'.
@@ -620,69 +1446,313 @@ def main():
                     ),
                     shell=True
                 )
-                mongo_backups.capture_rsync_stats(rsync_output)
-
-                # Unmount the LVM snapshot
+                self.capture_rsync_stats(rsync_output)
+            except Exception:
                 subprocess.call(
-                    'umount {0}'.format(temp_mount_point_lvsnap),
-                    shell=True
+                    'umount {0}'.format(temp_mount_point_lvsnap), shell=True
                 )
-
-                # Unmount the new volume.
                 subprocess.call(
-                    'umount {0}'.format(temp_mount_point_new_volume),
+                    'lvremove -y /dev/{0}/lvsnap'.format(self.vg_name),
                     shell=True
                 )
-
-                # Remove the LVM snapshot.
-                subprocess.call(
-                    'lvremove -y /dev/{0}/lvsnap'.
-                    format(mongo_backups.vg_name),
-                    shell=True
+                if self.barrier:
+                    self.barrier.fail(
+                        '{0} failed to copy its LVM snapshot.'.
+                        format(self.barrier.agent_id)
+                    )
+                self.abandon_new_volumes(
+                    volume_ids, attach_devices, temp_mount_point_new_volume
                 )
+                raise
 
-                # Create a snapshot of the new volume which now has a copy
-                # of the database.
-                mongo_backups.log(
-                    "Creating snapshot from volume [{0}]."
-                    .format(new_volume['VolumeId'])
-                )
-                snapshot = mongo_backups.ebs_create_snapshot(
-                    new_volume['VolumeId']
-                )
+            # Unmount the LVM snapshot
+            subprocess.call(
+                'umount {0}'.format(temp_mount_point_lvsnap),
+                shell=True
+            )
+
+            # Unmount the new volume.
+            subprocess.call(
+                'umount {0}'.format(temp_mount_point_new_volume),
+                shell=True
+            )
 
-                # Detach the new volume.
-                mongo_backups.log(
-                    "Detaching volume which contains the database "
-                    "backup [{0}].".
-                    format(new_volume['VolumeId'])
+            # Remove the LVM snapshot.
+            subprocess.call(
+                'lvremove -y /dev/{0}/lvsnap'.
+                format(self.vg_name),
+                shell=True
+            )
+
+            # Deactivate the striped volume group so its volumes are
+            # quiesced before they are snapshotted and detached.
+            if len(volume_ids) > 1:
+                subprocess.call(
+                    'vgchange -an {0}'.format(STAGING_VG_NAME), shell=True
                 )
-                mongo_backups.ebs_detach_volume(
-                    new_volume['VolumeId'], attach_device
+
+        # Never keep a snapshot of a backup set which failed while this
+        # agent was copying.
+        if self.barrier:
+            try:
+                self.barrier.check()
+            except Exception:
+                self.abandon_new_volumes(
+                    volume_ids, attach_devices, temp_mount_point_new_volume
                 )
-                waiter = mongo_backups.client.get_waiter('volume_available')
-                waiter.wait(VolumeIds=[new_volume['VolumeId']])
-                mongo_backups.log(
-                    "Volume detached [{0}].".format(new_volume['VolumeId'])
+                raise
+
+        with self.phase('ebs_snapshot'):
+            # Create snapshots of the new volumes which now have a copy
+            # of the database. Striped volumes share a StripeSetId so they
+            # are restored and retained together.
+            extra_tags = [[] for _ in volume_ids]
+            if len(volume_ids) > 1:
+                stripe_set_id = 'MongoBackups-{0}-{1}-{2}'.format(
+                    self.mongo_name, self.instance_id,
+                    int(self.stats['time_started'])
                 )
+                for index, tags in enumerate(extra_tags):
+                    tags.extend([
+                        {'Key': 'StripeSetId', 'Value': stripe_set_id},
+                        {'Key': 'StripeIndex', 'Value': str(index)},
+                        {'Key': 'StripeCount',
+                         'Value': str(len(volume_ids))},
+                        {'Key': 'StripeSize',
+                         'Value': '{0}k'.format(self.stripe_size)},
+                    ])
+            self.log(
+                "Creating snapshots from volumes [{0}]."
+                .format(', '.join(volume_ids))
+            )
+            # Every stripe shares one finish time, set before snapshotting
+            # starts as the snapshots are created concurrently.
+            self.stats['date_finished'] = dt.now().isoformat()
+            self.stats['time_finished'] = time.time()
+            snapshot_tags = [
+                self.snapshot_tags(self.stats['date_finished'], tags)
+                for tags in extra_tags
+            ]
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(volume_ids)) as executor:
+                futures = [
+                    executor.submit(self.ebs_create_snapshot, volume_id, tags)
+                    for volume_id, tags in zip(volume_ids, snapshot_tags)
+                ]
+            snapshots = [f.result() for f in futures if not f.exception()]
+            errors = [f.exception() for f in futures if f.exception()]
+
+            # Never leave part of a stripe set or backup set behind.
+            if errors:
+                for failed_snapshot in snapshots:
+                    self.ebs_delete_snapshot(failed_snapshot['SnapshotId'])
+                if self.barrier:
+                    self.barrier.fail(
+                        '{0} failed to create its EBS snapshots.'.
+                        format(self.barrier.agent_id)
+                    )
+                self.abandon_new_volumes(volume_ids, attach_devices)
+                raise errors[0]
+
+            snapshot_ids = [s['SnapshotId'] for s in snapshots]
+            snapshot = snapshots[0]
+            self.stats['snapshot_id'] = snapshot['SnapshotId']
+            self.stats['snapshot_ids'] = snapshot_ids
+        if self.barrier:
+            self.barrier.finished(snapshot_ids)
+
+        with self.phase('cleanup'):
+            # Detach the new volumes.
+            self.log(
+                "Detaching volumes which contain the database "
+                "backup [{0}].".
+                format(', '.join(volume_ids))
+            )
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(volume_ids)) as executor:
+                list(executor.map(
+                    self.ebs_detach_volume, volume_ids, attach_devices
+                ))
+            waiter = self.client.get_waiter('volume_available')
+            waiter.wait(VolumeIds=volume_ids)
+            self.log(
+                "Volumes detached [{0}].".format(', '.join(volume_ids))
+            )
 
-                mongo_backups.log(
+            for volume_id in volume_ids:
+                self.log(
                     "Deleting new volume [{0}]."
-                    .format(new_volume['VolumeId'])
+                    .format(volume_id)
                 )
-                mongo_backups.ebs_delete_volume(new_volume['VolumeId'])
+                self.ebs_delete_volume(volume_id)
 
-                mongo_backups.log(
-                    "Backup complete [snapshot_id={0}]."
-                    .format(snapshot['SnapshotId'])
-                )
+        self.log(
+            "Backup complete [snapshot_id={0}]."
+            .format(', '.join(snapshot_ids))
+        )
 
-                # Send snapshot tags to CloudWatch log stream.
-                mongo_backups.log(
-                    json.dumps(mongo_backups.snapshot_tags, indent=4),
-                    console=False
-                )
+        # Send each snapshot's tags to CloudWatch log stream.
+        self.log(
+            json.dumps(
+                collections.OrderedDict(zip(snapshot_ids, snapshot_tags)),
+                indent=4
+            ),
+            console=False
+        )
+
+        # Append this run's stats to the run-history store.
+        if self.history_location:
+            self.record_history()
+
+        return snapshot
+
+    @property
+    def lvm_snapshot_command(self):
+        """ The argument list which creates the LVM snapshot. """
+
+        return [
+            'lvcreate', '-L300M', '-s', '-n', 'lvsnap',
+            '/dev/mapper/{0}-{1}'.format(self.vg_name, self.lv_name)
+        ]
+
+    def validate_lvm_snapshot(self):
+        """ Raise if the LVM snapshot cannot be created, so mongo is never
+            locked for a snapshot which is bound to fail. """
+
+        origin = self.lvm_snapshot_command[-1]
+        if not os.path.exists(origin):
+            raise Exception(
+                'The logical volume {0} does not exist.'.format(origin)
+            )
+        if os.path.exists('/dev/{0}/lvsnap'.format(self.vg_name)):
+            raise Exception(
+                'An LVM snapshot already exists [/dev/{0}/lvsnap].'.
+                format(self.vg_name)
+            )
+        vg = lvm.vgOpen(self.vg_name, 'r')
+        if vg.getFreeSize() < 300 * 1024 * 1024:
+            raise Exception(
+                'The volume group {0} has less than 300MB free for the LVM '
+                'snapshot.'.format(self.vg_name)
+            )
+
+    def create_striped_volume(self, devices):
+        """ Stripe devices into one logical volume and return its
+            path. """
+
+        self.log(
+            "Creating striped volume [devices={0}, stripe_size={1}k]."
+            .format(', '.join(devices), self.stripe_size)
+        )
+        subprocess.check_call(['pvcreate', '-q'] + devices)
+        subprocess.check_call(['vgcreate', '-q', STAGING_VG_NAME] + devices)
+        subprocess.check_call([
+            'lvcreate', '-q', '-y', '--stripes', str(len(devices)),
+            '--stripesize', '{0}k'.format(self.stripe_size),
+            '--extents', '100%FREE', '--name', STAGING_LV_NAME,
+            STAGING_VG_NAME
+        ])
+        return '/dev/{0}/{1}'.format(STAGING_VG_NAME, STAGING_LV_NAME)
+
+    def abandon_new_volumes(self, volume_ids, devices, mount_point=None):
+        """ Unmount, detach and delete new volumes without taking a
+            snapshot of them. """
+
+        self.log(
+            "Abandoning new volumes [{0}].".format(', '.join(volume_ids))
+        )
+        if mount_point:
+            subprocess.call('umount {0}'.format(mount_point), shell=True)
+        if len(volume_ids) > 1:
+            subprocess.call(
+                'vgremove -q -f {0}'.format(STAGING_VG_NAME), shell=True
+            )
+        for volume_id, device in zip(volume_ids, devices):
+            self.ebs_detach_volume(volume_id, device)
+        waiter = self.client.get_waiter('volume_available')
+        waiter.wait(VolumeIds=volume_ids)
+        for volume_id in volume_ids:
+            self.ebs_delete_volume(volume_id)
+
+    def is_local_live_volume(self, volume):
+        """ Return True if volume is attached to this instance as one of
+            the volume group's physical block devices. """
+
+        attached_instance_id = volume['Attachments'][0]['InstanceId']
+        attached_device = volume['Attachments'][0]['Device']
+
+        return (attached_instance_id == self.instance_id and
+                attached_device in self.physical_block_devices)
 
+
+def main():
+    args = parse_args()
+
+    if args.stripes < 0 or args.max_stripes < 1:
+        sys.exit(
+            '--stripes must not be negative and --max-stripes must be '
+            'positive.'
+        )
+
+    mongo_backups = MongoBackups(
+        args.mongo_name, args.aws_region, args.vg_name, args.lv_name,
+        log_group_name=args.log_group_name, mongo_lock=args.mongo_lock,
+        mongo_uri_file=args.mongo_uri_file,
+        history_location=args.history_location,
+        backup_set_id=args.backup_set_id, max_lock_hold=args.max_lock_hold,
+        stripes=args.stripes, max_stripes=args.max_stripes,
+        stripe_size=args.stripe_size, target_duration=args.target_duration,
+        volume_throughput=args.volume_throughput
+    )
+
+    # A backup set is only consistent when its agents are synchronised
+    # through the barrier.
+    if bool(args.backup_set_id) != bool(args.barrier_uri_file):
+        sys.exit(
+            'You must provide both a backup_set_id and barrier_uri_file, or '
+            'neither.'
+        )
+
+    if args.action == 'orchestrate':
+        if not args.backup_set_id:
+            sys.exit(
+                'You must provide a backup_set_id and barrier_uri_file to '
+                'orchestrate.'
+            )
+        orchestrator = BackupSetOrchestrator(
+            read_uri_file(args.barrier_uri_file), args.backup_set_id,
+            parties=args.backup_set_parties, timeout=args.barrier_timeout,
+            lead=args.barrier_lead, log=mongo_backups.log,
+            finish_timeout=args.barrier_finish_timeout
+        )
+        orchestrator.run()
+        sys.exit(0)
+
+    if args.backup_set_id:
+        mongo_backups.barrier = BackupSetBarrier(
+            read_uri_file(args.barrier_uri_file), args.backup_set_id,
+            '{0}-{1}'.format(args.mongo_name, mongo_backups.instance_id),
+            timeout=args.barrier_timeout
+        )
+
+    mongo_backups.stats['date_started'] = dt.now().isoformat()
+    mongo_backups.stats['time_started'] = time.time()
+
+    _filter = mongo_backups.volume_filter
+    volumes = mongo_backups.client.describe_volumes(Filters=_filter)
+
+    if args.action == 'backup':
+        for volume in volumes['Volumes']:
+
+            # Confirm that the live volume we are checking belongs to this
+            # instance and shares the same block device attachment. If we dont
+            # do this, we could backup a mongo instance we dont want backing
+            # up.
+            if mongo_backups.is_local_live_volume(volume):
+                mongo_backups.backup(
+                    volume, wait_time=args.wait_time,
+                    seed_from_last_snapshot=args.seed_from_last_snapshot
+                )
                 sys.exit(0)
 
 
@@ -2,11 +2,43 @@
 
 __VERSION__ = '0.1'
 
+from array import array
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime as dt
+from datetime import timezone
 import argparse
 import boto3
+import fnmatch
+import gzip
+import math
+import os
 import sys
+import threading
 import collections
+import concurrent.futures
 import json
+import time
+
+# Must match the history store written by mongo-backups.py.
+HISTORY_SUFFIX = '.history.json.gz'
+
+# Columns of the history store holding strings. Every other column is loaded
+# as a numeric array.
+HISTORY_STRING_COLUMNS = (
+    'mongo_name', 'aws_region', 'instance_id', 'snapshot_id',
+    'backup_set_id', 'version'
+)
+
+# Retention periods, newest first, mapped to a function returning the bucket a
+# snapshot start time falls in. Only the newest snapshot of each bucket is
+# kept for a period.
+RETENTION_PERIODS = collections.OrderedDict([
+    ('hourly', lambda t: t.strftime('%Y-%m-%dT%H')),
+    ('daily', lambda t: t.strftime('%Y-%m-%d')),
+    ('weekly', lambda t: '{0}-W{1:02d}'.format(*t.isocalendar()[:2])),
+    ('monthly', lambda t: t.strftime('%Y-%m')),
+])
 
 
 def tag_search(_item, _dict):
@@ -18,31 +50,342 @@ def tag_search(_item, _dict):
     return found
 
 
+def split_s3_uri(uri):
+    """ Return a (bucket, prefix) tuple if uri is an s3:// uri, otherwise
+        None. """
+
+    if not uri.startswith('s3://'):
+        return None
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix = prefix + '/'
+    return bucket, prefix
+
+
+def percentile(sorted_values, pct):
+    """ Return the pct percentile of an already sorted sequence using linear
+        interpolation between the closest ranks. """
+
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * pct / 100.0
+    lower = int(math.floor(rank))
+    upper = int(math.ceil(rank))
+    return (
+        sorted_values[lower] +
+        (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+    )
+
+
+def linear_slope(xs, ys):
+    """ Return the least squares slope of ys over xs, or None if it cannot
+        be determined. """
+
+    n = len(xs)
+    if n < 2:
+        return None
+    mean_x = math.fsum(xs) / n
+    mean_y = math.fsum(ys) / n
+    var_x = math.fsum((x - mean_x) ** 2 for x in xs)
+    if not var_x:
+        return None
+    cov = math.fsum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    return cov / var_x
+
+
+def retention_unit(snapshot):
+    """ Return the id of the set snapshot is retained with: its BackupSetId
+        (every shard of a sharded cluster backup), its StripeSetId (every
+        striped staging volume) or, for a lone snapshot, its SnapshotId. """
+
+    tags = snapshot.get('Tags', [])
+    return (
+        tag_search('BackupSetId', tags) or tag_search('StripeSetId', tags) or
+        snapshot['SnapshotId']
+    )
+
+
+def retention_unit_completed(members):
+    """ Return True if every snapshot of a retention unit has completed,
+        every stripe set in it has all StripeCount of its snapshots and a
+        backup set holds one snapshot or stripe set from each of its
+        BackupSetParties agents. """
+
+    if any(s['State'] != 'completed' for s in members):
+        return False
+    stripe_sets = collections.Counter()
+    stripe_counts = {}
+    agents = set()
+    for snapshot in members:
+        tags = snapshot.get('Tags', [])
+        stripe_set_id = tag_search('StripeSetId', tags)
+        if stripe_set_id:
+            stripe_sets[stripe_set_id] += 1
+            stripe_counts[stripe_set_id] = int(
+                tag_search('StripeCount', tags) or 1
+            )
+        agents.add(stripe_set_id or snapshot['SnapshotId'])
+    if any(count < stripe_counts[stripe_set_id]
+           for stripe_set_id, count in stripe_sets.items()):
+        return False
+
+    tags = members[0].get('Tags', [])
+    if tag_search('BackupSetId', tags):
+        # Without a party count a backup set can never be shown complete.
+        parties = tag_search('BackupSetParties', tags)
+        return bool(parties) and len(agents) >= int(parties)
+    return True
+
+
+def retention_units(snapshots):
+    """ Return an ordered dict of retention_unit to its snapshots,
+        preserving the order of snapshots. """
+
+    units = collections.OrderedDict()
+    for snapshot in snapshots:
+        units.setdefault(retention_unit(snapshot), []).append(snapshot)
+    return units
+
+
+def retention_plan(snapshots, keep):
+    """ Split snapshots into a (keep, delete) tuple of lists.
+
+    snapshots must be a single cluster's snapshots, newest first. keep is a
+    dict of retention period name (see RETENTION_PERIODS) to the number of
+    buckets to keep. Snapshots sharing a retention_unit are kept or deleted
+    together, and a unit is only complete once every member has completed.
+    The newest complete unit and any incomplete unit are always kept.
+
+    """
+
+    units = retention_units(snapshots)
+
+    seen = {period: set() for period in RETENTION_PERIODS}
+    kept = []
+    deleted = []
+    newest_completed = True
+
+    for members in units.values():
+        if not retention_unit_completed(members):
+            kept.extend(members)
+            continue
+
+        retain = newest_completed
+        newest_completed = False
+        for period, bucket_of in RETENTION_PERIODS.items():
+            buckets = seen[period]
+            if len(buckets) >= keep.get(period, 0):
+                continue
+            bucket = bucket_of(members[0]['StartTime'])
+            if bucket not in buckets:
+                buckets.add(bucket)
+                retain = True
+
+        if retain:
+            kept.extend(members)
+        else:
+            deleted.extend(members)
+
+    return kept, deleted
+
+
+class RateLimiter:
+    """ A thread safe limiter which spaces calls to wait() at most rate
+        per second apart. """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(self.next_time, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
 def parse_args():
     """ Do all command line parsing and return the results as an argparse
         Namespace. """
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '--mongo-name', dest='mongo_name', required=True,
-        help='The name of the mongo cluster.'
+        '--mongo-name', dest='mongo_names', nargs='+', required=True,
+        help=('The names of the mongo clusters. Shell-style patterns are '
+              'accepted (eg; \'prod-*\').')
     )
     parser.add_argument(
-        '--aws-region', dest='aws_region', required=True,
-        help='The name of the AWS region the mongo cluster exists within.'
+        '--aws-region', dest='aws_regions', nargs='+', required=True,
+        help=('The names of the AWS regions the mongo clusters exist '
+              'within. Regions are queried concurrently.')
     )
     parser.add_argument(
         '--limit', dest='limit', type=int, required=False, default=1,
-        help=('The limit of backups to display.')
+        help=('The limit of backups to display per cluster.')
+    )
+    parser.add_argument(
+        '--action', dest='action', nargs='?',
+        choices=('snapshots', 'freshness', 'trends', 'prune'),
+        default='snapshots',
+        help=('Display the latest snapshots, a fleet-wide freshness report '
+              'or run-history trends, or prune snapshots outside the '
+              'retention policy.')
+    )
+    parser.add_argument(
+        '--max-age', dest='max_age', type=float, required=False, default=24,
+        help=('The age in hours after which a cluster\'s last completed '
+              'backup is considered stale.')
+    )
+    parser.add_argument(
+        '--history-location', dest='history_location', default=None,
+        help=('Local directory or s3://bucket/prefix holding the run-history '
+              'store written by mongo-backups.py.')
+    )
+    parser.add_argument(
+        '--days', dest='days', type=int, required=False, default=90,
+        help=('The number of days of run-history to analyse.')
+    )
+    parser.add_argument(
+        '--metric', dest='metrics', action='append', default=None,
+        help=('A run-history column to analyse. May be given more than once '
+              '(default: duration_seconds, rsync_total_file_size, '
+              'rsync_total_transferred_file_size).')
+    )
+    parser.add_argument(
+        '--window', dest='window', type=int, required=False, default=7,
+        help=('The number of runs in the moving average.')
+    )
+    parser.add_argument(
+        '--regression-threshold', dest='regression_threshold', type=float,
+        required=False, default=0.25,
+        help=('Alert when the latest run exceeds the moving average of the '
+              'previous runs by this fraction.')
+    )
+    for period in RETENTION_PERIODS:
+        parser.add_argument(
+            '--keep-{0}'.format(period), dest='keep_{0}'.format(period),
+            type=int, required=False, default=0,
+            help=('The number of {0} snapshots to keep per cluster when '
+                  'pruning.'.format(period))
+        )
+    parser.add_argument(
+        '--dry-run', dest='dry_run', action='store_true', default=False,
+        help=('Report what prune would delete without deleting anything.')
+    )
+    parser.add_argument(
+        '--delete-workers', dest='delete_workers', type=int,
+        required=False, default=8,
+        help=('The number of concurrent snapshot deletions when pruning.')
+    )
+    parser.add_argument(
+        '--delete-rate', dest='delete_rate', type=float,
+        required=False, default=10,
+        help=('The maximum snapshot deletions per second, per region.')
     )
     return parser.parse_args()
 
 
+class RunHistory:
+    """ The run-history store of every cluster, loaded into columns.
+
+    String columns are held as lists and numeric columns as arrays of
+    doubles, with NaN marking runs which did not record a value. Rows are
+    sorted by time_started.
+
+    """
+
+    def __init__(self, columns, runs):
+        self.runs = runs
+        order = sorted(
+            range(runs), key=lambda i: columns['time_started'][i] or 0
+        )
+        self.columns = {}
+        for name, values in columns.items():
+            values = [values[i] for i in order]
+            if name in HISTORY_STRING_COLUMNS:
+                self.columns[name] = values
+            else:
+                self.columns[name] = array(
+                    'd', [float('nan') if v is None else v for v in values]
+                )
+
+    @classmethod
+    def from_documents(cls, documents):
+        """ Concatenate the columns of several history documents, padding
+            columns missing from a document with None. """
+
+        names = set()
+        for document in documents:
+            names.update(document['columns'])
+
+        columns = {name: [] for name in names}
+        runs = 0
+        for document in documents:
+            for name in names:
+                columns[name].extend(
+                    document['columns'].get(name, [None] * document['runs'])
+                )
+            runs = runs + document['runs']
+
+        return cls(columns, runs)
+
+    def group_by(self, name):
+        """ Return an ordered dict of column value to the list of row
+            indexes holding it, in a single pass. """
+
+        groups = collections.OrderedDict()
+        for index, value in enumerate(self.columns[name]):
+            groups.setdefault(value, []).append(index)
+        return groups
+
+    def group_by_series(self):
+        """ Return an ordered dict of series name to the list of row
+            indexes in it.
+
+        A cluster's runs form one series named after it, except that each
+        agent of a sharded cluster backup set backs up a different shard
+        and so is its own <mongo_name>.<instance_id> series.
+
+        """
+
+        missing = [None] * self.runs
+        instance_ids = self.columns.get('instance_id', missing)
+        backup_set_ids = self.columns.get('backup_set_id', missing)
+
+        groups = collections.OrderedDict()
+        for index, mongo_name in enumerate(self.columns['mongo_name']):
+            name = mongo_name
+            if backup_set_ids[index]:
+                name = '{0}.{1}'.format(mongo_name, instance_ids[index])
+            groups.setdefault(name, []).append(index)
+        return groups
+
+
 class QueryMongoBackups:
-    def __init__(self, mongo_name, aws_region, limit):
-        self.mongo_name = mongo_name
-        self.aws_region = aws_region
+    def __init__(self, mongo_names, aws_regions, limit, **kwargs):
+        self.mongo_names = mongo_names
+        self.aws_regions = aws_regions
         self.limit = limit
+        self.max_age = kwargs.get('max_age', 24)
+
+        # Run-history attributes.
+        self.history_location = kwargs.get('history_location')
+        self.days = kwargs.get('days', 90)
+        self.metrics = kwargs.get('metrics') or [
+            'duration_seconds', 'rsync_total_file_size',
+            'rsync_total_transferred_file_size'
+        ]
+        self.window = kwargs.get('window', 7)
+        self.regression_threshold = kwargs.get('regression_threshold', 0.25)
+
+        # Retention attributes.
+        self.keep = kwargs.get('keep') or {}
+        self.dry_run = kwargs.get('dry_run', False)
+        self.delete_workers = kwargs.get('delete_workers', 8)
+        self.delete_rate = kwargs.get('delete_rate', 10)
 
     @property
     def session(self):
@@ -50,6 +393,12 @@ class QueryMongoBackups:
 
         return boto3.session.Session()
 
+    @property
+    def aws_region(self):
+        """ The region used for non-regional resources such as S3. """
+
+        return self.aws_regions[0]
+
     @property
     def client(self):
         """ A client connection to EC2. """
@@ -57,53 +406,428 @@ class QueryMongoBackups:
         return self.session.client('ec2', self.aws_region)
 
     @property
-    def all_snapshots(self):
-        """ Return an ordered dict (by date) of snapshots for mongo_name. """
+    def s3(self):
+        """ A client connection to S3. """
 
-        _filter = [
-            {'Name': 'tag:MongoName', 'Values': [self.mongo_name]},
-            {'Name': 'tag:MongoBackups', 'Values': ['True']},
-        ]
+        return self.session.client('s3', self.aws_region)
 
-        result = self.client.describe_snapshots(Filters=_filter)
-        snapshots = {}
+    def match_mongo_name(self, mongo_name):
+        """ Return True if mongo_name matches any of mongo_names. """
 
-        for snapshot in result['Snapshots']:
+        return any(
+            fnmatch.fnmatchcase(mongo_name or '', pattern)
+            for pattern in self.mongo_names
+        )
 
-            start_time = snapshot['StartTime']
-            human_readable_start_time = start_time.isoformat()
+    @property
+    def tag_filter_values(self):
+        """ Return mongo_names as EC2 tag filter values. EC2 only supports
+            the * and ? wildcards, so patterns using character classes are
+            widened to * and matched client-side instead. """
+
+        if any('[' in pattern for pattern in self.mongo_names):
+            return ['*']
+        return self.mongo_names
+
+    def scan_region(self, aws_region):
+        """ Return a tuple of (snapshots, live cluster names) for every
+            matching cluster in aws_region.
+
+        This is one paginated, server-side filtered scan of snapshots and
+        one of live volumes for the whole region, regardless of how many
+        clusters it holds.
+
+        """
+
+        # Sessions are not thread safe, so each region gets its own.
+        client = self.session.client('ec2', aws_region)
+        mongo_name_filter = {
+            'Name': 'tag:MongoName', 'Values': self.tag_filter_values
+        }
+
+        snapshots = []
+        paginator = client.get_paginator('describe_snapshots')
+        pages = paginator.paginate(
+            OwnerIds=['self'],
+            Filters=[
+                mongo_name_filter,
+                {'Name': 'tag:MongoBackups', 'Values': ['True']},
+            ],
+            PaginationConfig={'PageSize': 1000}
+        )
+        for page in pages:
+            for snapshot in page['Snapshots']:
+                if self.match_mongo_name(
+                        tag_search('MongoName', snapshot.get('Tags', []))):
+                    snapshot['Region'] = aws_region
+                    snapshots.append(snapshot)
+
+        live = set()
+        paginator = client.get_paginator('describe_volumes')
+        pages = paginator.paginate(
+            Filters=[
+                mongo_name_filter,
+                {'Name': 'tag:MongoLiveVolume', 'Values': ['True']},
+            ],
+            PaginationConfig={'PageSize': 500}
+        )
+        for page in pages:
+            for volume in page['Volumes']:
+                mongo_name = tag_search('MongoName', volume.get('Tags', []))
+                if self.match_mongo_name(mongo_name):
+                    live.add(mongo_name)
+
+        return snapshots, live
 
-            tags = snapshot['Tags']
+    @property
+    def fleet(self):
+        """ Scan every region concurrently and return a tuple of an ordered
+            dict (by cluster name) of snapshot lists, newest first, and a
+            dict of live cluster name to the regions it runs in. """
+
+        clusters = {}
+        live = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.aws_regions)) as executor:
+            results = executor.map(self.scan_region, self.aws_regions)
+            for aws_region, (snapshots, live_names) in zip(
+                    self.aws_regions, results):
+                for snapshot in snapshots:
+                    mongo_name = tag_search('MongoName', snapshot['Tags'])
+                    clusters.setdefault(mongo_name, []).append(snapshot)
+                for mongo_name in live_names:
+                    live.setdefault(mongo_name, []).append(aws_region)
+
+        fleet = collections.OrderedDict()
+        for mongo_name in sorted(clusters):
+            fleet[mongo_name] = sorted(
+                clusters[mongo_name], key=lambda t: t['StartTime'],
+                reverse=True
+            )
+        return fleet, live
 
-            snapshot_data = {
-                'Description': snapshot['Description'],
-                'Encrypted': snapshot['Encrypted'],
-                'Progress': snapshot['Progress'],
-                'SnapshotId': snapshot['SnapshotId'],
-                'DateStarted': tag_search('DateStarted', tags),
-                'DateFinished': tag_search('DateFinished', tags),
-                'MongoName': tag_search('MongoName', tags),
-                'InstanceId': tag_search('InstanceId', tags),
-            }
+    @property
+    def all_snapshots(self):
+        """ Return an ordered dict (by cluster name) of ordered dicts (by
+            SnapshotId, newest first) of the latest limit snapshots of every
+            matching cluster. """
+
+        fleet, _ = self.fleet
+        snapshots = collections.OrderedDict()
+
+        for mongo_name, cluster_snapshots in fleet.items():
+            cluster = snapshots[mongo_name] = collections.OrderedDict()
+            for snapshot in cluster_snapshots[:self.limit]:
+
+                tags = snapshot['Tags']
+
+                snapshot_data = {
+                    'Description': snapshot['Description'],
+                    'Encrypted': snapshot['Encrypted'],
+                    'Progress': snapshot['Progress'],
+                    'SnapshotId': snapshot['SnapshotId'],
+                    'StartTime': snapshot['StartTime'].isoformat(),
+                    'Region': snapshot['Region'],
+                    'DateStarted': tag_search('DateStarted', tags),
+                    'DateFinished': tag_search('DateFinished', tags),
+                    'MongoName': tag_search('MongoName', tags),
+                    'InstanceId': tag_search('InstanceId', tags),
+                }
+
+                rsync_stats = {}
+                for tag in tags:
+                    if tag['Key'].startswith('rsync_'):
+                        rsync_stats[tag['Key']] = tag['Value']
+
+                # include all rsync stats
+                data = {**snapshot_data, **rsync_stats}
+                od = collections.OrderedDict(sorted(data.items()))
+                cluster[snapshot['SnapshotId']] = od
+
+        return snapshots
 
-            rsync_stats = {}
-            for tag in tags:
-                if tag['Key'].startswith('rsync_'):
-                    rsync_stats[tag['Key']] = tag['Value']
+    @property
+    def freshness(self):
+        """ Return a fleet-wide report of each cluster's last completed
+            backup and whether it is older than max_age hours.
+
+        A backup is completed under the same rules as retention: every
+        snapshot of its stripe set or backup set must have completed (see
+        retention_unit_completed). Clusters with a live volume but no
+        completed backup are reported as stale.
+
+        """
+
+        fleet, live = self.fleet
+        now = dt.now(timezone.utc)
+
+        clusters = collections.OrderedDict()
+        for mongo_name in sorted(set(fleet) | set(live)):
+            snapshots = fleet.get(mongo_name, [])
+            completed = [s for s in snapshots if s['State'] == 'completed']
+            units = [
+                members for members in retention_units(snapshots).values()
+                if retention_unit_completed(members)
+            ]
+            cluster = collections.OrderedDict([
+                ('Regions', sorted(
+                    set(live.get(mongo_name, [])) |
+                    set(s['Region'] for s in snapshots)
+                )),
+                ('Live', mongo_name in live),
+                ('Pending', len(snapshots) - len(completed)),
+                ('SnapshotId', None),
+                ('LastBackup', None),
+                ('AgeHours', None),
+                ('Fresh', False),
+            ])
+            if units:
+                last = units[0][0]
+                age = (now - last['StartTime']).total_seconds() / 3600
+                cluster['SnapshotId'] = last['SnapshotId']
+                cluster['LastBackup'] = last['StartTime'].isoformat()
+                cluster['AgeHours'] = round(age, 2)
+                cluster['Fresh'] = age <= self.max_age
+            clusters[mongo_name] = cluster
+
+        stale = [name for name, c in clusters.items() if not c['Fresh']]
+        return collections.OrderedDict([
+            ('Generated', now.isoformat()),
+            ('MaxAgeHours', self.max_age),
+            ('Regions', self.aws_regions),
+            ('Clusters', len(clusters)),
+            ('Stale', stale),
+            ('Report', clusters),
+        ])
+
+    def delete_snapshot(self, client, limiter, snapshot_id):
+        """ Delete snapshot_id once limiter allows and return an error
+            message, or None on success.
+
+        Throttled requests are retried by the client's adaptive retry
+        mode. A snapshot which no longer exists counts as deleted.
+
+        """
+
+        limiter.wait()
+        try:
+            client.delete_snapshot(SnapshotId=snapshot_id)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'InvalidSnapshot.NotFound':
+                return None
+            return '{0}: {1}'.format(code, e.response['Error']['Message'])
+        return None
+
+    def prune_snapshots(self):
+        """ Apply the retention policy to every matching cluster and
+            return a report of the kept and deleted snapshots.
+
+        Deletions across the fleet run on a shared worker pool, with each
+        region rate limited to delete_rate calls per second. Nothing is
+        deleted if dry_run is set.
+
+        """
+
+        if not any(self.keep.values()):
+            raise Exception(
+                'You must keep at least one hourly, daily, weekly or monthly '
+                'snapshot when pruning.'
+            )
+
+        fleet, _ = self.fleet
+
+        report = collections.OrderedDict()
+        to_delete = []
+        for mongo_name, snapshots in fleet.items():
+            kept, deleted = retention_plan(snapshots, self.keep)
+            report[mongo_name] = collections.OrderedDict([
+                ('Kept', len(kept)),
+                ('Deleted', [s['SnapshotId'] for s in deleted]),
+                ('Errors', collections.OrderedDict()),
+            ])
+            to_delete.extend((mongo_name, s) for s in deleted)
+
+        if self.dry_run or not to_delete:
+            return report
+
+        # boto3 clients, unlike sessions, are thread safe so one client
+        # per region is shared by every worker.
+        config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+        session = self.session
+        regions = set(s['Region'] for _, s in to_delete)
+        clients = {
+            region: session.client('ec2', region, config=config)
+            for region in regions
+        }
+        limiters = {
+            region: RateLimiter(self.delete_rate) for region in regions
+        }
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.delete_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.delete_snapshot, clients[s['Region']],
+                    limiters[s['Region']], s['SnapshotId']
+                ): (mongo_name, s['SnapshotId'])
+                for mongo_name, s in to_delete
+            }
+            for future in concurrent.futures.as_completed(futures):
+                mongo_name, snapshot_id = futures[future]
+                error = future.result()
+                if error:
+                    report[mongo_name]['Errors'][snapshot_id] = error
+                    report[mongo_name]['Deleted'].remove(snapshot_id)
+
+        return report
+
+    def history_documents(self):
+        """ Yield every decoded history document within history_location
+            whose cluster name matches mongo_names. """
+
+        if not self.history_location:
+            raise Exception('You must provide a history_location for trends.')
+
+        # Backup set agents write one history object per instance.
+        patterns = []
+        for name in self.mongo_names:
+            patterns.append(name + HISTORY_SUFFIX)
+            patterns.append(name + '.i-*' + HISTORY_SUFFIX)
+        s3_uri = split_s3_uri(self.history_location)
+        if s3_uri:
+            bucket, prefix = s3_uri
+            s3 = self.s3
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    name = obj['Key'][len(prefix):]
+                    if '/' in name or not any(
+                            fnmatch.fnmatchcase(name, pattern)
+                            for pattern in patterns):
+                        continue
+                    body = s3.get_object(Bucket=bucket, Key=obj['Key'])
+                    yield json.loads(
+                        gzip.decompress(body['Body'].read()).decode()
+                    )
+            return
+
+        if not os.path.isdir(self.history_location):
+            raise Exception(
+                'The history_location {0} is not a directory.'.
+                format(self.history_location)
+            )
+        for name in sorted(os.listdir(self.history_location)):
+            if not any(fnmatch.fnmatchcase(name, pattern)
+                       for pattern in patterns):
+                continue
+            with open(os.path.join(self.history_location, name), 'rb') as fh:
+                yield json.loads(gzip.decompress(fh.read()).decode())
 
-            # include all rsync stats
-            data = {**snapshot_data, **rsync_stats}
-            od = collections.OrderedDict(sorted(data.items()))
-            snapshots[human_readable_start_time] = od
+    @property
+    def history(self):
+        """ The RunHistory of every matching cluster. """
+
+        return RunHistory.from_documents(list(self.history_documents()))
+
+    def metric_trend(self, times, values):
+        """ Return percentiles, moving average, growth rate and regression
+            status for one metric of one cluster. values and times must be
+            aligned and sorted by time. """
+
+        sorted_values = sorted(values)
+        latest = values[-1]
+        previous = values[-self.window - 1:-1]
+        moving_average = math.fsum(previous) / len(previous) \
+            if previous else None
+
+        # Growth is the least squares slope per day, also expressed
+        # relative to the mean so clusters of differing sizes compare.
+        slope = linear_slope([t / 86400.0 for t in times], values)
+        mean = math.fsum(values) / len(values)
+        growth_pct = slope / mean * 100 if slope is not None and mean \
+            else None
+
+        regressed = bool(
+            moving_average and
+            latest > moving_average * (1 + self.regression_threshold)
+        )
+
+        return collections.OrderedDict([
+            ('latest', latest),
+            ('p50', percentile(sorted_values, 50)),
+            ('p90', percentile(sorted_values, 90)),
+            ('p99', percentile(sorted_values, 99)),
+            ('moving_average', moving_average),
+            ('growth_per_day', slope),
+            ('growth_pct_per_day', growth_pct),
+            ('regressed', regressed),
+        ])
 
-        snapshots_ordered_by_date = collections.OrderedDict()
-        for key, value in sorted(
-                snapshots.items(), key=lambda t: t[0], reverse=True):
-            if len(snapshots_ordered_by_date) == self.limit:
-                break
-            snapshots_ordered_by_date[key] = value
+    @property
+    def trends(self):
+        """ Return an ordered dict (by series name, see
+            RunHistory.group_by_series) of run-history trends over the last
+            days. """
 
-        return snapshots_ordered_by_date
+        string_metrics = [
+            m for m in self.metrics if m in HISTORY_STRING_COLUMNS
+        ]
+        if string_metrics:
+            raise Exception(
+                'Trends can only be computed for numeric run-history '
+                'columns, not {0}.'.format(', '.join(string_metrics))
+            )
+
+        history = self.history
+        if not history.runs:
+            return collections.OrderedDict()
+
+        since = time.time() - self.days * 86400
+        time_started = history.columns['time_started']
+
+        report = collections.OrderedDict()
+        groups = history.group_by_series()
+        for series in sorted(groups):
+            rows = [i for i in groups[series] if time_started[i] >= since]
+            if not rows:
+                continue
+
+            cluster = collections.OrderedDict([
+                ('runs', len(rows)),
+                ('first', dt.fromtimestamp(
+                    time_started[rows[0]], timezone.utc).isoformat()),
+                ('last', dt.fromtimestamp(
+                    time_started[rows[-1]], timezone.utc).isoformat()),
+            ])
+            alerts = []
+
+            for metric in self.metrics:
+                column = history.columns.get(metric)
+                if column is None:
+                    continue
+                # Drop runs which did not record this metric (NaN).
+                present = [i for i in rows if column[i] == column[i]]
+                if not present:
+                    continue
+                trend = self.metric_trend(
+                    [time_started[i] for i in present],
+                    [column[i] for i in present]
+                )
+                cluster[metric] = trend
+                if trend['regressed']:
+                    alerts.append(
+                        '{0} regressed: latest {1:.6g} is more than {2:.0%} '
+                        'above the {3} run moving average {4:.6g}.'.
+                        format(metric, trend['latest'],
+                               self.regression_threshold, self.window,
+                               trend['moving_average'])
+                    )
+
+            cluster['alerts'] = alerts
+            report[series] = cluster
+
+        return report
 
 
 def main():
@@ -113,10 +837,35 @@ def main():
 
     args = parse_args()
 
+    if args.delete_rate <= 0 or args.delete_workers < 1:
+        sys.exit('--delete-rate and --delete-workers must be positive.')
+
     mongo_backups = QueryMongoBackups(
-        args.mongo_name, args.aws_region, args.limit
+        args.mongo_names, args.aws_regions, args.limit,
+        max_age=args.max_age,
+        history_location=args.history_location, days=args.days,
+        metrics=args.metrics, window=args.window,
+        regression_threshold=args.regression_threshold,
+        keep={
+            period: getattr(args, 'keep_{0}'.format(period))
+            for period in RETENTION_PERIODS
+        },
+        dry_run=args.dry_run, delete_workers=args.delete_workers,
+        delete_rate=args.delete_rate
     )
-    report = json.dumps(mongo_backups.all_snapshots, indent=4)
+    if args.action == 'trends':
+        report = json.dumps(mongo_backups.trends, indent=4)
+    elif args.action == 'freshness':
+        freshness = mongo_backups.freshness
+        print(json.dumps(freshness, indent=4))
+        # Exit non-zero so fleet checks can alert on stale clusters.
+        return 1 if freshness['Stale'] else 0
+    elif args.action == 'prune':
+        prune = mongo_backups.prune_snapshots()
+        print(json.dumps(prune, indent=4))
+        return 1 if any(c['Errors'] for c in prune.values()) else 0
+    else:
+        report = json.dumps(mongo_backups.all_snapshots, indent=4)
     print(report)
 
 
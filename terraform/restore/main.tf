@@ -1,6 +1,8 @@
 variable "ssh_public_key" {}
 variable "my_ip" {}
-variable "snapshot_id" {}
+variable "snapshot_id" {
+  description = "The snapshot to restore. For a striped backup, any snapshot of its stripe set."
+}
 
 provider "aws" {
   region = "ap-southeast-2"
@@ -10,21 +10,64 @@ apt-get update -y
 
 # Setup snapshot
 apt-get install -y awscli jq
-VOLUME_ID=$(
-    aws ec2 --region=${region} create-volume --snapshot-id=${snapshot_id} \
-            --availability-zone=${availability_zone} \
-            --encrypted | jq .VolumeId | tr -d "'" | tr -d '"'
-)
-
-aws ec2 wait volume-available --region=${region} --volume-ids $VOLUME_ID
-aws ec2 attach-volume --region=${region} \
-    --volume-id $VOLUME_ID --instance-id $INSTANCE_ID --device=${device}
-aws ec2 wait volume-in-use --region=${region} --volume-ids $VOLUME_ID
-while test ! -b ${device}; do
-    sleep 1
-done
+
+# Create a volume from snapshot $1 and attach it at device $2.
+attach_snapshot() {
+    VOLUME_ID=$(
+        aws ec2 --region=${region} create-volume --snapshot-id=$1 \
+                --availability-zone=${availability_zone} \
+                --encrypted | jq .VolumeId | tr -d "'" | tr -d '"'
+    )
+
+    aws ec2 wait volume-available --region=${region} --volume-ids $VOLUME_ID
+    aws ec2 attach-volume --region=${region} \
+        --volume-id $VOLUME_ID --instance-id $INSTANCE_ID --device=$2
+    aws ec2 wait volume-in-use --region=${region} --volume-ids $VOLUME_ID
+    while test ! -b $2; do
+        sleep 1
+    done
+}
+
+snapshot_tag() {
+    aws ec2 --region=${region} describe-snapshots \
+        --snapshot-ids=${snapshot_id} \
+        --query "Snapshots[0].Tags[?Key=='$1'].Value | [0]" --output text
+}
+
+# A striped backup is one snapshot per staging volume, sharing a
+# StripeSetId, of the vgmongobackups/lvmongobackups striped logical volume.
+# snapshot_id may be any one of them. Every stripe is restored, in
+# StripeIndex order, to consecutive devices from ${device}.
+STRIPE_SET_ID=$(snapshot_tag StripeSetId)
+if test "$STRIPE_SET_ID" != "None"; then
+    STRIPE_COUNT=$(snapshot_tag StripeCount)
+    SNAPSHOT_IDS=$(
+        aws ec2 --region=${region} describe-snapshots --owner-ids=self \
+            --filters="Name=tag:StripeSetId,Values=$STRIPE_SET_ID" \
+            --query "Snapshots[].[Tags[?Key=='StripeIndex'].Value | [0], SnapshotId]" \
+            --output text | sort -n | cut -f2
+    )
+    test $(echo "$SNAPSHOT_IDS" | wc -l) -eq $STRIPE_COUNT
+    aws ec2 wait snapshot-completed --region=${region} \
+        --snapshot-ids $SNAPSHOT_IDS
+
+    DEVICE_PREFIX=$(echo ${device} | sed 's/.$//')
+    DEVICE_LETTER=$(echo ${device} | sed 's/.*\(.\)$/\1/')
+    for SNAPSHOT_ID in $SNAPSHOT_IDS; do
+        attach_snapshot $SNAPSHOT_ID $DEVICE_PREFIX$DEVICE_LETTER
+        DEVICE_LETTER=$(echo $DEVICE_LETTER | tr 'a-y' 'b-z')
+    done
+
+    apt-get install -y lvm2
+    vgscan
+    vgchange -ay vgmongobackups
+    DATA_DEVICE=/dev/vgmongobackups/lvmongobackups
+else
+    attach_snapshot ${snapshot_id} ${device}
+    DATA_DEVICE=${device}
+fi
 mkdir -p ${mount_point}
-mount ${device} ${mount_point}
+mount $DATA_DEVICE ${mount_point}
 
 # Install salt-minion
 wget -O - https://repo.saltstack.com/apt/ubuntu/16.04/amd64/latest/SALTSTACK-GPG-KEY.pub | sudo apt-key add -
@@ -0,0 +1,30 @@
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(file_name, module_name):
+    """ Import a script whose file name is not a valid module name. """
+
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(ROOT, file_name)
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def query():
+    return load_script('query-mongo-backups.py', 'query_mongo_backups')
+
+
+@pytest.fixture(scope='session')
+def mongo_backups():
+    # The lvm bindings come from the system's lvm2 package and cannot be
+    # installed from PyPI.
+    pytest.importorskip('lvm')
+    return load_script('mongo-backups.py', 'mongo_backups')
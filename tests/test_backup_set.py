@@ -0,0 +1,147 @@
+""" Exercise BackupSetOrchestrator and BackupSetBarrier against a local
+    sharded cluster. Set MONGO_BACKUPS_TEST_MONGOS_URI to a mongos URI (eg;
+    one started with mlaunch init --sharded 2 --replicaset) to run them. """
+
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+MONGOS_URI = os.environ.get('MONGO_BACKUPS_TEST_MONGOS_URI')
+
+pytestmark = pytest.mark.skipif(
+    not MONGOS_URI, reason='MONGO_BACKUPS_TEST_MONGOS_URI is not set'
+)
+
+
+@pytest.fixture
+def backup_set_id(mongo_backups):
+    backup_set_id = 'test-{0}'.format(uuid.uuid4())
+    yield backup_set_id
+    mongo_backups.MongoClient(MONGOS_URI).mongo_backups.backup_sets.\
+        delete_one({'_id': backup_set_id})
+
+
+def run_agents(mongo_backups, backup_set_id, poll_intervals,
+               failing=(), copy_seconds=0):
+    """ Run one agent thread per poll interval through a backup set and
+        return a dict of agent id to the exception it raised, if any.
+
+    Agents named in failing fail the set while copying. Every other agent
+    copies for copy_seconds, then checks the set before recording its EBS
+    snapshot.
+
+    """
+
+    errors = {}
+
+    def agent(agent_id, poll_interval):
+        barrier = mongo_backups.BackupSetBarrier(
+            MONGOS_URI, backup_set_id, agent_id, timeout=30,
+            poll_interval=poll_interval
+        )
+        try:
+            barrier.wait()
+            lock_started = time.time()
+            barrier.snapshotted(lock_started, time.time())
+            if agent_id in failing:
+                barrier.fail('{0} failed to copy.'.format(agent_id))
+                raise Exception('Copy failed.')
+            time.sleep(copy_seconds)
+            barrier.check()
+            barrier.finished(['snap-{0}'.format(agent_id)])
+        except Exception as e:
+            errors[agent_id] = e
+
+    threads = [
+        threading.Thread(
+            target=agent, args=('agent{0}'.format(i), poll_interval)
+        )
+        for i, poll_interval in enumerate(poll_intervals)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads, errors
+
+
+def test_orchestrator_releases_agents_together(mongo_backups, backup_set_id):
+    orchestrator = mongo_backups.BackupSetOrchestrator(
+        MONGOS_URI, backup_set_id, parties=3, timeout=30, lead=0.5
+    )
+    threads, errors = run_agents(
+        mongo_backups, backup_set_id, [0.01, 0.01, 0.01]
+    )
+
+    window = orchestrator.run()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert window['parties'] == 3
+    assert window['lock_start_spread'] < 0.5
+    assert sorted(window['snapshot_ids']) == [
+        'snap-agent0', 'snap-agent1', 'snap-agent2'
+    ]
+    backup_set = orchestrator.collection.find_one({'_id': backup_set_id})
+    assert backup_set['state'] == 'completed'
+
+
+def test_late_agent_fails_backup_set(mongo_backups, backup_set_id):
+    orchestrator = mongo_backups.BackupSetOrchestrator(
+        MONGOS_URI, backup_set_id, parties=2, timeout=30, lead=0.2
+    )
+    # The second agent only polls every 2s, so it sees the release long
+    # after the lead has passed.
+    threads, errors = run_agents(mongo_backups, backup_set_id, [0.01, 2])
+
+    with pytest.raises(Exception):
+        orchestrator.run()
+    for thread in threads:
+        thread.join()
+
+    assert 'agent1' in errors
+    backup_set = orchestrator.collection.find_one({'_id': backup_set_id})
+    assert backup_set['state'] == 'failed'
+    assert 'agent1' in backup_set['reason']
+
+
+def test_agent_failing_after_release_fails_backup_set(mongo_backups,
+                                                      backup_set_id):
+    orchestrator = mongo_backups.BackupSetOrchestrator(
+        MONGOS_URI, backup_set_id, parties=2, timeout=30, lead=0.2
+    )
+    threads, errors = run_agents(
+        mongo_backups, backup_set_id, [0.01, 0.01], failing=['agent1'],
+        copy_seconds=1
+    )
+
+    with pytest.raises(Exception, match='agent1 failed to copy'):
+        orchestrator.run()
+    for thread in threads:
+        thread.join()
+
+    # The agent which copied successfully never records its snapshot.
+    assert set(errors) == {'agent0', 'agent1'}
+    backup_set = orchestrator.collection.find_one({'_id': backup_set_id})
+    assert backup_set['state'] == 'failed'
+    assert 'finished' not in backup_set
+
+
+def test_backup_set_id_cannot_be_reused(mongo_backups, backup_set_id):
+    orchestrator = mongo_backups.BackupSetOrchestrator(
+        MONGOS_URI, backup_set_id, parties=1, timeout=30, lead=0.2
+    )
+    threads, errors = run_agents(mongo_backups, backup_set_id, [0.01])
+    orchestrator.run()
+    for thread in threads:
+        thread.join()
+
+    with pytest.raises(Exception, match='already been run'):
+        orchestrator.run()
+    barrier = mongo_backups.BackupSetBarrier(
+        MONGOS_URI, backup_set_id, 'agent0'
+    )
+    with pytest.raises(Exception, match='already been released'):
+        barrier.wait()
@@ -0,0 +1,246 @@
+import gzip
+import json
+import time
+
+import botocore.session
+from botocore.awsrequest import AWSResponse
+import pytest
+
+
+@pytest.fixture
+def backups(mongo_backups, monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        mongo_backups.MongoBackups, 'instance_id', 'i-0123456789abcdef0'
+    )
+    backups = mongo_backups.MongoBackups(
+        'test', 'us-east-1', 'vgtest', 'lvtest',
+        history_location=str(tmp_path)
+    )
+    backups.stats.update({
+        'time_started': 1000.0, 'time_finished': 1060.0,
+        'snapshot_id': 'snap-1', 'lock_hold_seconds': 0.25,
+        'rsync_stats': [
+            {'Key': 'rsync_total_file_size', 'Value': '2048'},
+        ],
+    })
+    return backups
+
+
+class FakeS3:
+    """ Answer S3 calls from a queue of responses. Like MongoBackups.s3,
+        every access builds a client from a new session, whose exception
+        classes differ from those of every other client. """
+
+    def __init__(self):
+        self.responses = []
+        self.calls = []
+
+    def client(self):
+        session = botocore.session.get_session()
+        session.register(
+            'provide-client-params.s3', self.provide_client_params
+        )
+        session.register('before-call.s3', self.before_call)
+        return session.create_client(
+            's3', 'us-east-1', aws_access_key_id='test',
+            aws_secret_access_key='test'
+        )
+
+    def add_response(self, status, parsed):
+        self.responses.append((status, parsed))
+
+    def add_error(self, status, code):
+        self.add_response(
+            status, {'Error': {'Code': code, 'Message': code}}
+        )
+
+    def provide_client_params(self, params, model, **kwargs):
+        self.calls.append((model.name, dict(params)))
+
+    def before_call(self, **kwargs):
+        status, parsed = self.responses.pop(0)
+        parsed.setdefault('ResponseMetadata', {})['HTTPStatusCode'] = status
+        return AWSResponse(None, status, {}, None), parsed
+
+
+@pytest.fixture
+def s3(mongo_backups, monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(
+        mongo_backups.MongoBackups, 's3', property(lambda self: fake.client())
+    )
+    return fake
+
+
+def decode(body):
+    return json.loads(gzip.decompress(body).decode())
+
+
+def test_history_append_creates_local_history(backups, tmp_path):
+    backups.history_append()
+    backups.stats['time_started'] = 2000.0
+    backups.stats['time_finished'] = 2030.0
+    backups.history_append()
+
+    history = decode((tmp_path / 'test.history.json.gz').read_bytes())
+    assert history['runs'] == 2
+    assert history['columns']['duration_seconds'] == [60.0, 30.0]
+    assert history['columns']['rsync_total_file_size'] == [2048.0, 2048.0]
+
+
+def test_history_append_creates_s3_history(backups, s3):
+    backups.history_location = 's3://bucket/history'
+    s3.add_error(404, 'NoSuchKey')
+    s3.add_response(200, {})
+
+    history = backups.history_append()
+
+    assert [(name, params['Key']) for name, params in s3.calls] == [
+        ('GetObject', 'history/test.history.json.gz'),
+        ('PutObject', 'history/test.history.json.gz'),
+    ]
+    assert history['runs'] == 1
+    assert decode(s3.calls[1][1]['Body']) == history
+
+
+def test_record_history_logs_failures(backups, s3):
+    backups.history_location = 's3://bucket/history'
+    s3.add_error(403, 'AccessDenied')
+
+    assert backups.record_history() is False
+
+
+def test_record_history_logs_bad_directories(backups, tmp_path):
+    backups.history_location = str(tmp_path / 'file')
+    (tmp_path / 'file').write_text('not a directory')
+
+    assert backups.record_history() is False
+
+
+class FakeAdmin:
+    """ Records the admin commands sent to a fake mongod. """
+
+    def __init__(self, locked=False):
+        self.locked = locked
+        self.commands = []
+
+    def command(self, name, **kwargs):
+        self.commands.append(name)
+        if name == 'currentOp':
+            return {'fsyncLock': self.locked}
+        if name == 'fsync':
+            self.locked = True
+        elif name == 'fsyncUnlock':
+            self.locked = False
+        return {'ok': 1}
+
+
+@pytest.fixture
+def admin(mongo_backups, monkeypatch):
+    admin = FakeAdmin()
+
+    class FakeClient:
+        def __init__(self, uri):
+            self.admin = admin
+
+    monkeypatch.setattr(mongo_backups, 'MongoClient', FakeClient)
+    return admin
+
+
+def test_lock_window_holds_lock_for_the_command(mongo_backups, admin):
+    lock_window = mongo_backups.LockWindow('mongodb://test', max_hold=5)
+    lock_window.prepare()
+
+    lock_window.run(['sleep', '0.1'])
+
+    assert admin.commands == ['ping', 'currentOp', 'fsync', 'fsyncUnlock']
+    assert not admin.locked
+    assert 0.1 <= lock_window.hold_seconds < 1
+    assert not lock_window.forced
+
+
+def test_lock_window_watchdog_unlocks_without_killing(mongo_backups, admin):
+    lock_window = mongo_backups.LockWindow('mongodb://test', max_hold=0.2)
+    lock_window.prepare()
+
+    start = time.monotonic()
+    with pytest.raises(Exception, match='force-unlocked'):
+        lock_window.run(['sleep', '1'])
+
+    # The command ran to completion, but the hold stopped at the unlock.
+    assert time.monotonic() - start >= 1
+    assert admin.commands.count('fsyncUnlock') == 1
+    assert not admin.locked
+    assert lock_window.forced
+    assert 0.2 <= lock_window.hold_seconds < 0.6
+
+
+@pytest.mark.parametrize('command', [['false'], ['/nonexistent/command']])
+def test_lock_window_unlocks_when_the_command_fails(mongo_backups, admin,
+                                                     command):
+    lock_window = mongo_backups.LockWindow('mongodb://test', max_hold=5)
+    lock_window.prepare()
+
+    with pytest.raises(Exception):
+        lock_window.run(command)
+
+    assert not admin.locked
+    assert lock_window.hold_seconds is not None
+    assert not lock_window.forced
+
+
+def test_lock_window_rejects_locked_mongod(mongo_backups, admin):
+    admin.locked = True
+    lock_window = mongo_backups.LockWindow('mongodb://test')
+
+    with pytest.raises(Exception, match='already fsync locked'):
+        lock_window.prepare()
+    assert 'fsync' not in admin.commands
+
+
+def test_lock_window_without_mongo_records_no_hold(mongo_backups):
+    lock_window = mongo_backups.LockWindow(None, max_hold=0.1)
+    lock_window.prepare()
+
+    lock_window.run(['sleep', '0.3'])
+
+    assert lock_window.hold_seconds is None
+    assert lock_window.hold_text == 'not locked'
+
+
+GB = 1024 ** 3
+
+
+@pytest.mark.parametrize('stripes, data_size, expected', [
+    # An explicit stripe count is used as is.
+    (4, 10 * GB, 4),
+    # 125MB/s for 1800s copies about 220GB per stripe.
+    (0, 100 * GB, 1),
+    (0, 500 * GB, 3),
+    # Clamped to at least one stripe and at most max_stripes.
+    (0, 0, 1),
+    (0, 10240 * GB, 8),
+])
+def test_stripe_count(mongo_backups, monkeypatch, stripes, data_size,
+                      expected):
+    monkeypatch.setattr(
+        mongo_backups.MongoBackups, 'data_size', data_size
+    )
+    backups = mongo_backups.MongoBackups(
+        'test', 'us-east-1', 'vgtest', 'lvtest', stripes=stripes,
+        max_stripes=8, target_duration=1800, volume_throughput=125
+    )
+
+    assert backups.stripe_count == expected
+
+
+def test_snapshot_tags_use_the_given_finish_time(backups):
+    backups.stats['date_started'] = '2026-10-18T11:00:00'
+    extra_tags = [{'Key': 'StripeIndex', 'Value': '1'}]
+
+    tags = backups.snapshot_tags('2026-10-18T12:00:00', extra_tags)
+
+    assert {'Key': 'DateFinished', 'Value': '2026-10-18T12:00:00'} in tags
+    assert {'Key': 'rsync_total_file_size', 'Value': '2048'} in tags
+    assert tags[-1] == extra_tags[0]
+    assert 'date_finished' not in backups.stats
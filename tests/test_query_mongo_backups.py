@@ -0,0 +1,517 @@
+from datetime import datetime, timedelta, timezone
+import gzip
+import json
+import time
+
+import botocore.session
+from botocore.stub import Stubber
+import pytest
+
+
+NOW = datetime(2026, 10, 18, 12, tzinfo=timezone.utc)
+
+
+def snapshot(snapshot_id, hours_ago, state='completed', tags=None):
+    return {
+        'SnapshotId': snapshot_id,
+        'StartTime': NOW - timedelta(hours=hours_ago),
+        'State': state,
+        'Tags': tags or [],
+    }
+
+
+def ids(snapshots):
+    return [s['SnapshotId'] for s in snapshots]
+
+
+def test_retention_plan_keeps_newest_of_each_bucket(query):
+    # Every 6 hours for 10 days, newest first.
+    snapshots = [snapshot(str(h), h) for h in range(0, 240, 6)]
+
+    kept, deleted = query.retention_plan(snapshots, {'daily': 3})
+
+    # 12:00, 06:00 and 00:00 fall on 2026-10-18; 18 is the newest on the
+    # 17th and 42 the newest on the 16th.
+    assert ids(kept) == ['0', '18', '42']
+    assert len(kept) + len(deleted) == len(snapshots)
+
+
+def test_retention_plan_unions_periods(query):
+    snapshots = [snapshot(str(h), h) for h in range(0, 24 * 70, 6)]
+
+    kept, _ = query.retention_plan(snapshots, {'hourly': 2, 'monthly': 3})
+
+    # Two hourly buckets, then the newest of September and August.
+    assert ids(kept) == ['0', '6', '426', '1146']
+
+
+def test_retention_plan_keeps_pending_snapshots(query):
+    snapshots = [
+        snapshot('pending', 0, state='pending'),
+        snapshot('a', 1),
+        snapshot('b', 30),
+        snapshot('old-pending', 300, state='pending'),
+    ]
+
+    kept, deleted = query.retention_plan(snapshots, {'hourly': 1})
+
+    assert ids(kept) == ['pending', 'a', 'old-pending']
+    assert ids(deleted) == ['b']
+
+
+def test_retention_plan_always_keeps_newest_completed(query):
+    # Every snapshot falls outside the single monthly bucket kept by the
+    # newest, except the newest itself.
+    snapshots = [snapshot('a', 0), snapshot('b', 1), snapshot('c', 2)]
+
+    kept, deleted = query.retention_plan(snapshots, {'monthly': 1})
+    assert ids(kept) == ['a']
+    assert ids(deleted) == ['b', 'c']
+
+    kept, _ = query.retention_plan(snapshots, {'hourly': 0, 'daily': 0})
+    assert ids(kept) == ['a']
+
+
+def backup_set_tags(backup_set_id, parties):
+    return [
+        {'Key': 'BackupSetId', 'Value': backup_set_id},
+        {'Key': 'BackupSetParties', 'Value': str(parties)},
+    ]
+
+
+def test_retention_plan_keeps_backup_sets_whole(query):
+    # 3 shards x 5 hourly backup sets under one MongoName, each shard's
+    # snapshot starting a few seconds apart.
+    snapshots = []
+    for backup_set in range(5):
+        for shard in range(3):
+            s = snapshot(
+                's{0}-{1}'.format(backup_set, shard), backup_set,
+                tags=backup_set_tags('set{0}'.format(backup_set), 3)
+            )
+            s['StartTime'] -= timedelta(seconds=shard)
+            snapshots.append(s)
+
+    kept, deleted = query.retention_plan(snapshots, {'hourly': 3})
+
+    assert ids(kept) == [
+        's0-0', 's0-1', 's0-2', 's1-0', 's1-1', 's1-2',
+        's2-0', 's2-1', 's2-2',
+    ]
+    assert len(deleted) == 6
+
+
+def test_retention_plan_keeps_incomplete_backup_sets(query):
+    backup_set = backup_set_tags('new', 2)
+    snapshots = [
+        snapshot('new-0', 0, tags=backup_set),
+        snapshot('new-1', 0, state='pending', tags=backup_set),
+        snapshot('old', 30),
+        snapshot('older', 60),
+    ]
+
+    kept, deleted = query.retention_plan(snapshots, {'daily': 1})
+
+    # The incomplete set does not take the newest completed slot.
+    assert ids(kept) == ['new-0', 'new-1', 'old']
+    assert ids(deleted) == ['older']
+
+
+def test_retention_plan_keeps_backup_sets_missing_parties(query):
+    # Only two shards of the newest three shard set were snapshotted.
+    new = backup_set_tags('new', 3)
+    old = backup_set_tags('old', 3)
+    snapshots = [
+        snapshot('new-0', 0, tags=new),
+        snapshot('new-1', 0, tags=new),
+        snapshot('old-0', 30, tags=old),
+        snapshot('old-1', 30, tags=old),
+        snapshot('old-2', 30, tags=old),
+        snapshot('older', 60),
+    ]
+
+    kept, deleted = query.retention_plan(snapshots, {'daily': 1})
+
+    assert ids(kept) == ['new-0', 'new-1', 'old-0', 'old-1', 'old-2']
+    assert ids(deleted) == ['older']
+
+
+def test_retention_plan_counts_striped_backup_set_parties(query):
+    # Each party of a backup set may be a whole stripe set.
+    snapshots = [
+        snapshot('a-0', 0, tags=backup_set_tags('new', 2) +
+                 stripe_set('a', 2)),
+        snapshot('a-1', 0, tags=backup_set_tags('new', 2) +
+                 stripe_set('a', 2)),
+        snapshot('b', 0, tags=backup_set_tags('new', 2)),
+        snapshot('old', 30),
+    ]
+
+    kept, deleted = query.retention_plan(snapshots, {'daily': 1})
+
+    assert ids(kept) == ['a-0', 'a-1', 'b']
+    assert ids(deleted) == ['old']
+
+
+def stripe_set(stripe_set_id, count):
+    return [
+        {'Key': 'StripeSetId', 'Value': stripe_set_id},
+        {'Key': 'StripeCount', 'Value': str(count)},
+    ]
+
+
+def test_retention_plan_keeps_incomplete_stripe_sets(query):
+    snapshots = [
+        snapshot('a-0', 0, tags=stripe_set('a', 2)),
+        snapshot('a-1', 0, state='pending', tags=stripe_set('a', 2)),
+        snapshot('b-0', 30, tags=stripe_set('b', 2)),
+        snapshot('b-1', 30, tags=stripe_set('b', 2)),
+        snapshot('c-0', 60, tags=stripe_set('c', 2)),
+        snapshot('c-1', 60, tags=stripe_set('c', 2)),
+    ]
+
+    kept, deleted = query.retention_plan(snapshots, {'daily': 1})
+
+    assert ids(kept) == ['a-0', 'a-1', 'b-0', 'b-1']
+    assert ids(deleted) == ['c-0', 'c-1']
+
+
+def test_retention_plan_keeps_stripe_sets_missing_members(query):
+    # Only one of set a's three snapshots exists yet.
+    snapshots = [
+        snapshot('a-0', 0, tags=stripe_set('a', 3)),
+        snapshot('b-0', 30, tags=stripe_set('b', 1)),
+        snapshot('c-0', 60, tags=stripe_set('c', 1)),
+    ]
+
+    kept, deleted = query.retention_plan(snapshots, {'daily': 1})
+
+    assert ids(kept) == ['a-0', 'b-0']
+    assert ids(deleted) == ['c-0']
+
+
+def test_percentile_interpolates_between_ranks(query):
+    values = [1.0, 2.0, 3.0, 4.0]
+
+    assert query.percentile(values, 0) == 1.0
+    assert query.percentile(values, 50) == 2.5
+    assert query.percentile(values, 90) == pytest.approx(3.7)
+    assert query.percentile(values, 100) == 4.0
+    assert query.percentile([], 50) is None
+
+
+def test_linear_slope(query):
+    assert query.linear_slope([0, 1, 2, 3], [1, 3, 5, 7]) == 2.0
+    assert query.linear_slope([1], [1]) is None
+    assert query.linear_slope([2, 2], [1, 3]) is None
+
+
+def test_run_history_sorts_and_pads_columns(query):
+    documents = [
+        {'runs': 2, 'columns': {
+            'mongo_name': ['b', 'b'],
+            'time_started': [300.0, 100.0],
+            'duration_seconds': [30.0, None],
+        }},
+        {'runs': 1, 'columns': {
+            'mongo_name': ['a'],
+            'time_started': [200.0],
+        }},
+    ]
+
+    history = query.RunHistory.from_documents(documents)
+
+    assert history.runs == 3
+    assert history.columns['mongo_name'] == ['b', 'a', 'b']
+    assert list(history.columns['time_started']) == [100.0, 200.0, 300.0]
+    duration = list(history.columns['duration_seconds'])
+    assert duration[2] == 30.0
+    # Missing values are NaN.
+    assert duration[0] != duration[0] and duration[1] != duration[1]
+    assert history.group_by('mongo_name') == {'b': [0, 2], 'a': [1]}
+
+
+def test_metric_trend_flags_regressions(query):
+    query_backups = query.QueryMongoBackups(
+        ['test'], ['us-east-1'], 1, window=3, regression_threshold=0.25
+    )
+    days = [day * 86400.0 for day in range(5)]
+
+    trend = query_backups.metric_trend(days, [10.0, 10.0, 10.0, 10.0, 13.0])
+
+    assert trend['latest'] == 13.0
+    assert trend['moving_average'] == 10.0
+    assert trend['p50'] == 10.0
+    assert trend['growth_per_day'] == pytest.approx(0.6)
+    assert trend['regressed'] is True
+
+    trend = query_backups.metric_trend(days, [10.0, 10.0, 10.0, 10.0, 12.0])
+    assert trend['regressed'] is False
+
+
+def test_trends_rejects_string_metrics(query):
+    query_backups = query.QueryMongoBackups(
+        ['test'], ['us-east-1'], 1, history_location='/nonexistent',
+        metrics=['instance_id']
+    )
+
+    with pytest.raises(Exception, match='numeric'):
+        query_backups.trends
+
+
+def test_history_documents_rejects_missing_directory(query, tmp_path):
+    query_backups = query.QueryMongoBackups(
+        ['test'], ['us-east-1'], 1, history_location=str(tmp_path / 'none')
+    )
+
+    with pytest.raises(Exception, match='not a directory'):
+        list(query_backups.history_documents())
+
+
+class FakeSession:
+    """ Stands in for QueryMongoBackups.session, handing out one stubbed
+        EC2 client per region. """
+
+    def __init__(self, regions):
+        self.clients = {}
+        self.stubbers = {}
+        for region in regions:
+            client = botocore.session.get_session().create_client(
+                'ec2', region, aws_access_key_id='test',
+                aws_secret_access_key='test'
+            )
+            self.clients[region] = client
+            self.stubbers[region] = Stubber(client)
+
+    def client(self, service, region, **kwargs):
+        return self.clients[region]
+
+    def activate(self):
+        for stubber in self.stubbers.values():
+            stubber.activate()
+
+    def assert_no_pending_responses(self):
+        for stubber in self.stubbers.values():
+            stubber.assert_no_pending_responses()
+
+
+@pytest.fixture
+def session(query, monkeypatch):
+    sessions = []
+
+    def make(*regions):
+        fake = FakeSession(regions)
+        monkeypatch.setattr(
+            query.QueryMongoBackups, 'session', property(lambda self: fake)
+        )
+        sessions.append(fake)
+        return fake
+
+    yield make
+    for fake in sessions:
+        fake.assert_no_pending_responses()
+
+
+def ec2_snapshot(snapshot_id, mongo_name, hours_ago, state='completed',
+                 tags=None):
+    return {
+        'SnapshotId': snapshot_id,
+        'StartTime': datetime.now(timezone.utc) - timedelta(hours=hours_ago),
+        'State': state,
+        'Tags': [
+            {'Key': 'MongoName', 'Value': mongo_name},
+            {'Key': 'MongoBackups', 'Value': 'True'},
+        ] + (tags or []),
+    }
+
+
+def ec2_volume(mongo_name):
+    return {'VolumeId': 'vol-' + mongo_name, 'Tags': [
+        {'Key': 'MongoName', 'Value': mongo_name},
+        {'Key': 'MongoLiveVolume', 'Value': 'True'},
+    ]}
+
+
+def expect_scan(stubber, name_filter, snapshot_pages, volumes):
+    """ Expect one paginated scan of a region's snapshots and one of its
+        live volumes. """
+
+    for page, snapshots in enumerate(snapshot_pages):
+        params = {
+            'OwnerIds': ['self'],
+            'Filters': [
+                {'Name': 'tag:MongoName', 'Values': name_filter},
+                {'Name': 'tag:MongoBackups', 'Values': ['True']},
+            ],
+            'MaxResults': 1000,
+        }
+        response = {'Snapshots': snapshots}
+        if page:
+            params['NextToken'] = str(page)
+        if page < len(snapshot_pages) - 1:
+            response['NextToken'] = str(page + 1)
+        stubber.add_response('describe_snapshots', response, params)
+    stubber.add_response('describe_volumes', {'Volumes': volumes}, {
+        'Filters': [
+            {'Name': 'tag:MongoName', 'Values': name_filter},
+            {'Name': 'tag:MongoLiveVolume', 'Values': ['True']},
+        ],
+        'MaxResults': 500,
+    })
+
+
+def test_scan_region_pages_once_and_matches_client_side(query, session):
+    fake = session('us-east-1')
+    expect_scan(
+        fake.stubbers['us-east-1'], ['*'],
+        [
+            [ec2_snapshot('snap-a', 'prod-a', 1),
+             ec2_snapshot('snap-c', 'prod-c', 2)],
+            [ec2_snapshot('snap-b', 'prod-b', 3)],
+        ],
+        [ec2_volume('prod-a'), ec2_volume('dev-a')]
+    )
+    fake.activate()
+
+    query_backups = query.QueryMongoBackups(['prod-[ab]'], ['us-east-1'], 1)
+    snapshots, live = query_backups.scan_region('us-east-1')
+
+    # EC2 filters cannot express [ab], so the scan is widened to * and the
+    # pattern applied to each result.
+    assert ids(snapshots) == ['snap-a', 'snap-b']
+    assert all(s['Region'] == 'us-east-1' for s in snapshots)
+    assert live == {'prod-a'}
+
+
+def test_fleet_groups_regions_by_cluster(query, session):
+    fake = session('us-east-1', 'eu-west-1')
+    expect_scan(
+        fake.stubbers['us-east-1'], ['prod-*'],
+        [[ec2_snapshot('snap-a1', 'prod-a', 5),
+          ec2_snapshot('snap-b1', 'prod-b', 1)]],
+        [ec2_volume('prod-a')]
+    )
+    expect_scan(
+        fake.stubbers['eu-west-1'], ['prod-*'],
+        [[ec2_snapshot('snap-a2', 'prod-a', 2)]],
+        [ec2_volume('prod-a')]
+    )
+    fake.activate()
+
+    query_backups = query.QueryMongoBackups(
+        ['prod-*'], ['us-east-1', 'eu-west-1'], 1
+    )
+    fleet, live = query_backups.fleet
+
+    assert list(fleet) == ['prod-a', 'prod-b']
+    assert ids(fleet['prod-a']) == ['snap-a2', 'snap-a1']
+    assert live == {'prod-a': ['us-east-1', 'eu-west-1']}
+
+
+def expect_freshness_fleet(fake):
+    expect_scan(
+        fake.stubbers['us-east-1'], ['prod-*'],
+        [[
+            ec2_snapshot('snap-fresh', 'prod-fresh', 1),
+            ec2_snapshot('snap-pending', 'prod-stale', 1, state='pending'),
+            ec2_snapshot('snap-stale', 'prod-stale', 30),
+        ]],
+        [ec2_volume('prod-fresh'), ec2_volume('prod-stale'),
+         ec2_volume('prod-missing')]
+    )
+    fake.activate()
+
+
+def test_freshness_reports_stale_and_missing_clusters(query, session):
+    expect_freshness_fleet(session('us-east-1'))
+
+    query_backups = query.QueryMongoBackups(
+        ['prod-*'], ['us-east-1'], 1, max_age=24
+    )
+    freshness = query_backups.freshness
+
+    assert freshness['Stale'] == ['prod-missing', 'prod-stale']
+    report = freshness['Report']
+    assert report['prod-fresh']['Fresh'] is True
+    assert report['prod-stale']['SnapshotId'] == 'snap-stale'
+    assert report['prod-stale']['Pending'] == 1
+    assert report['prod-missing']['Live'] is True
+    assert report['prod-missing']['SnapshotId'] is None
+
+
+def test_main_exits_non_zero_for_stale_clusters(query, session, monkeypatch,
+                                                capsys):
+    expect_freshness_fleet(session('us-east-1'))
+    monkeypatch.setattr('sys.argv', [
+        'query-mongo-backups.py', '--mongo-name', 'prod-*',
+        '--aws-region', 'us-east-1', '--action', 'freshness'
+    ])
+
+    assert query.main() == 1
+    assert json.loads(capsys.readouterr().out)['Clusters'] == 3
+
+
+def write_history(path, columns):
+    runs = len(columns['time_started'])
+    path.write_bytes(gzip.compress(json.dumps(
+        {'format_version': 1, 'runs': runs, 'columns': columns}
+    ).encode()))
+
+
+def test_trends_give_each_backup_set_agent_its_own_series(query, tmp_path):
+    now = time.time()
+    # Two shards of one cluster, one much larger than the other, whose
+    # runs interleave.
+    for instance_id, duration in (('i-1', 100.0), ('i-2', 1000.0)):
+        write_history(
+            tmp_path / 'prod.{0}.history.json.gz'.format(instance_id), {
+                'mongo_name': ['prod'] * 4,
+                'instance_id': [instance_id] * 4,
+                'backup_set_id': ['set{0}'.format(i) for i in range(4)],
+                'time_started': [now - (4 - i) * 3600 for i in range(4)],
+                'duration_seconds': [duration] * 4,
+            }
+        )
+    write_history(tmp_path / 'dev.history.json.gz', {
+        'mongo_name': ['dev'], 'instance_id': ['i-3'],
+        'backup_set_id': [None], 'time_started': [now - 60],
+        'duration_seconds': [10.0],
+    })
+
+    query_backups = query.QueryMongoBackups(
+        ['prod', 'dev'], ['us-east-1'], 1, history_location=str(tmp_path),
+        metrics=['duration_seconds'], window=2
+    )
+    trends = query_backups.trends
+
+    assert list(trends) == ['dev', 'prod.i-1', 'prod.i-2']
+    assert trends['prod.i-2']['runs'] == 4
+    assert trends['prod.i-2']['duration_seconds']['moving_average'] == 1000.0
+    assert not trends['prod.i-1']['alerts']
+    assert not trends['prod.i-2']['alerts']
+
+
+def test_freshness_skips_incomplete_sets(query, session):
+    fake = session('us-east-1')
+    expect_scan(
+        fake.stubbers['us-east-1'], ['prod-*'],
+        [[
+            ec2_snapshot('a-0', 'prod-a', 1, tags=stripe_set('a', 2)),
+            ec2_snapshot('b-0', 'prod-a', 30, tags=stripe_set('b', 2)),
+            ec2_snapshot('b-1', 'prod-a', 30, tags=stripe_set('b', 2)),
+            ec2_snapshot('c-0', 'prod-c', 1,
+                         tags=backup_set_tags('set', 2)),
+        ]],
+        [ec2_volume('prod-a'), ec2_volume('prod-c')]
+    )
+    fake.activate()
+
+    query_backups = query.QueryMongoBackups(
+        ['prod-*'], ['us-east-1'], 1, max_age=24
+    )
+    freshness = query_backups.freshness
+
+    # prod-a's newest stripe set is missing a stripe, so its last complete
+    # backup is a day old; prod-c's only backup set is missing a party.
+    assert freshness['Report']['prod-a']['SnapshotId'] in ('b-0', 'b-1')
+    assert freshness['Stale'] == ['prod-a', 'prod-c']